@@ -0,0 +1,202 @@
+"""Benchmark decrypt.py and CryptMiddleware on generated Crypt4GH files.
+
+Generates a dataset with generate_data.py, unless --data-dir already holds one, and times
+get_private_keys, move_files, decrypt_files and remove_files on a fresh copy of it --repeat
+times, as the decryption executor runs them. apply_middleware is timed on a task with one input
+per file of the dataset. Each operation is run once more under tracemalloc to measure the peak
+memory it allocates. The results are written as JSON, so runs on different commits can be
+compared.
+
+Usage:
+    python3 benchmarks/bench_decrypt.py [--data-dir DIR] [--count 10] [--size 64M] [--keys 1]
+        [--recipients 1] [--foreign 0.0] [--jobs 1] [--repeat 3] [--output results.json]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import json
+import logging
+from pathlib import Path
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+import flask
+
+from crypt4gh_middleware.decrypt import (
+    decrypt_files,
+    get_available_cpus,
+    get_private_keys,
+    move_files,
+    remove_files,
+)
+from crypt4gh_middleware.middleware import CryptMiddleware
+
+from bench_middleware import make_task_body
+from generate_data import DATASET_NAME, Dataset, add_spec_arguments, generate_dataset, get_spec
+
+# Version of the layout of the results, increased when it changes incompatibly
+RESULTS_VERSION = 1
+
+
+class Measurements:
+    """Timings and peak memory of the benchmarked operations."""
+
+    def __init__(self):
+        self.seconds: dict[str, list[float]] = {}
+        self.peak_memory: dict[str, int] = {}
+        # Number of files and bytes processed by each run of an operation
+        self.work: dict[str, tuple[int, int]] = {}
+
+    def run(self, name: str, function: Callable[[], Any], trace: bool = False) -> Any:
+        """Run a function, recording its duration or, with trace, its peak traced memory."""
+        if trace:
+            tracemalloc.start()
+            try:
+                result = function()
+                self.peak_memory[name] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return result
+        start = time.perf_counter()
+        result = function()
+        self.seconds.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def results(self) -> list[dict]:
+        """Summarize the measurements of each operation."""
+        results = []
+        for name, seconds in self.seconds.items():
+            files, size = self.work.get(name, (0, 0))
+            median = statistics.median(seconds)
+            results.append({
+                "name": name,
+                "runs": len(seconds),
+                "files": files,
+                "bytes": size,
+                "seconds": seconds,
+                "min_seconds": min(seconds),
+                "median_seconds": median,
+                "max_seconds": max(seconds),
+                "latency_seconds_per_file": median / files if files else None,
+                "throughput_bytes_per_second": size / median if size and median else None,
+                "peak_traced_memory_bytes": self.peak_memory.get(name),
+            })
+        return results
+
+
+def _copy_dataset(dataset: Dataset, directory: Path) -> list[Path]:
+    """Copy the secret keys and Crypt4GH files of a dataset to an empty directory."""
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    copies = []
+    for file_path in dataset.all_files:
+        shutil.copyfile(file_path, directory/file_path.name)
+        copies.append(directory/file_path.name)
+    return copies
+
+
+def run_executor(measurements: Measurements, dataset: Dataset, work_dir: Path, jobs: int,
+                 trace: bool = False):
+    """Run the operations of the decryption executor on a fresh copy of a dataset."""
+    copies = _copy_dataset(dataset, work_dir/"src")
+    output_dir = work_dir/"out"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    output_dir.mkdir()
+    key_copies = copies[:len(dataset.secret_keys)]
+    keys = measurements.run("get_private_keys", lambda: get_private_keys(key_copies), trace)
+    measurements.work["get_private_keys"] = (len(key_copies), 0)
+    moved = measurements.run("move_files", lambda: move_files(copies, output_dir), trace)
+    measurements.work["move_files"] = (len(copies), 0)
+    file_paths = moved[len(dataset.secret_keys):]
+    measurements.work["decrypt_files"] = (
+        len(file_paths), sum(file_path.stat().st_size for file_path in file_paths))
+    measurements.run("decrypt_files", lambda: decrypt_files(file_paths, keys, jobs=jobs), trace)
+    stats = measurements.run("remove_files", lambda: remove_files(output_dir, jobs=jobs), trace)
+    measurements.work["remove_files"] = (stats.files, stats.bytes_wiped)
+
+
+def run_middleware(measurements: Measurements, app: flask.Flask, inputs: int,
+                   trace: bool = False):
+    """Apply the middleware to a task with the given number of inputs."""
+    with app.test_request_context(json=make_task_body(inputs)):
+        request = flask.request
+        request.get_json()
+        measurements.run("apply_middleware",
+                         lambda: CryptMiddleware().apply_middleware(request), trace)
+
+
+def get_commit() -> Optional[str]:
+    """Return the commit of the working tree, or None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, check=True,
+                              text=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run the benchmarks and write the results as JSON."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", type=Path,
+                        help="directory of a dataset to reuse or generate, temporary by default")
+    add_spec_arguments(parser)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="jobs passed to decrypt_files and remove_files")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="file to write the results to, stdout if "
+                                                     "omitted")
+    args = parser.parse_args()
+    spec = get_spec(parser, args)
+    # Logging every file would be part of the timings
+    logging.disable(logging.CRITICAL)
+
+    with TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or Path(temp_dir)/"data"
+        if (data_dir/DATASET_NAME).exists():
+            dataset = Dataset.load(data_dir/DATASET_NAME)
+        else:
+            dataset = generate_dataset(data_dir, spec)
+        measurements = Measurements()
+        for _ in range(args.repeat):
+            run_executor(measurements, dataset, Path(temp_dir)/"work", args.jobs)
+        run_executor(measurements, dataset, Path(temp_dir)/"work", args.jobs, trace=True)
+
+    app = flask.Flask(__name__)
+    inputs = len(dataset.all_files)
+    for _ in range(args.repeat):
+        run_middleware(measurements, app, inputs)
+    run_middleware(measurements, app, inputs, trace=True)
+    measurements.work["apply_middleware"] = (inputs, 0)
+
+    files = len(dataset.files) + len(dataset.foreign_files)
+    report = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": get_available_cpus(),
+        "parameters": {"count": files, "size": dataset.file_size,
+                       "keys": len(dataset.secret_keys), "recipients": dataset.recipients,
+                       "foreign": len(dataset.foreign_files) / files if files else 0.0,
+                       "jobs": args.jobs, "repeat": args.repeat},
+        "results": measurements.results(),
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
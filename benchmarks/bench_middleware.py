@@ -0,0 +1,135 @@
+"""Microbenchmark for the path rewriting done by CryptMiddleware.
+
+Builds TES task bodies with n inputs and an executor with n arguments referencing them and
+times apply_middleware for increasing n. With --composite the arguments are joined into a single
+shell one-liner instead. With a rewrite table the time per input should stay
+roughly constant, i.e. the total time scales linearly.
+
+With --templates, the admission throughput of tasks that share a template and only differ in
+their input URLs is measured instead, with and without the template cache of CryptMiddleware.
+With --batch, such tasks are submitted as one JSON array to apply_batch_json instead, and
+compared with a request per task.
+
+Usage:
+    python3 benchmarks/bench_middleware.py [--sizes 100 1000 10000] [--repeat 5] [--composite]
+        [--templates | --batch] [--requests 1000]
+"""
+from argparse import ArgumentParser
+import json
+import time
+
+import flask
+
+from crypt4gh_middleware.middleware import TEMPLATE_CACHE_SIZE, CryptMiddleware
+
+
+def make_task_body(size: int, composite: bool = False, bucket: str = "bucket") -> dict:
+    """Return a task body with size inputs and size command arguments."""
+    paths = [f"/inputs/sample_{i}.c4gh" for i in range(size)]
+    command = ["bash", "-c", f"cat {' '.join(paths)} | wc -c"] if composite else ["cat"] + paths
+    return {
+        "inputs": [{"url": f"s3://{bucket}{path}", "path": path, "type": "FILE"}
+                   for path in paths],
+        "outputs": [{"url": "s3://bucket/out.txt", "path": "/outputs/out.txt", "type": "FILE"}],
+        "executors": [{
+            "image": "ubuntu",
+            "command": command,
+            "stdin": paths[0],
+            "workdir": "/outputs",
+            "env": {"FIRST": paths[0], "LAST": paths[-1]},
+        }],
+        "volumes": [],
+    }
+
+
+def time_apply(app: flask.Flask, size: int, repeat: int, composite: bool) -> float:
+    """Return the best time in seconds to apply the middleware to a task of the given size."""
+    best = float("inf")
+    for _ in range(repeat):
+        with app.test_request_context(json=make_task_body(size, composite)):
+            request = flask.request
+            request.get_json()
+            start = time.perf_counter()
+            CryptMiddleware().apply_middleware(request)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_admission(app: flask.Flask, size: int, requests: int, composite: bool,
+                   cache_size: int) -> float:
+    """Return the seconds taken to apply one middleware to requests tasks of the same template.
+
+    Each task reads its inputs from another bucket, so only the URLs differ between them.
+    """
+    middleware = CryptMiddleware(template_cache_size=cache_size)
+    seconds = 0.0
+    for index in range(requests):
+        with app.test_request_context(json=make_task_body(size, composite, f"bucket{index}")):
+            request = flask.request
+            request.get_json()
+            start = time.perf_counter()
+            middleware.apply_middleware(request)
+            seconds += time.perf_counter() - start
+    return seconds
+
+
+def time_batch(app: flask.Flask, size: int, requests: int, composite: bool
+               ) -> tuple[float, float]:
+    """Return the seconds taken to admit requests tasks of the same template from their JSON
+    with a request per task and with a single batch."""
+    bodies = [json.dumps(make_task_body(size, composite, f"bucket{index}"))
+              for index in range(requests)]
+    middleware = CryptMiddleware()
+    start = time.perf_counter()
+    for body in bodies:
+        with app.test_request_context(data=body, content_type="application/json"):
+            request = flask.request
+            request.get_json()
+            middleware.apply_middleware(request)
+    separate = time.perf_counter() - start
+    data = f"[{','.join(bodies)}]"
+    start = time.perf_counter()
+    CryptMiddleware().apply_batch_json(data)
+    return separate, time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark and print one line per size."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--composite", action="store_true",
+                        help="pass all paths in a single shell command argument")
+    parser.add_argument("--templates", action="store_true",
+                        help="measure the admission throughput of tasks of the same template")
+    parser.add_argument("--batch", action="store_true",
+                        help="measure the admission throughput of a batch of tasks")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="tasks applied per size with --templates or --batch")
+    args = parser.parse_args()
+
+    app = flask.Flask(__name__)
+    if args.batch:
+        print(f"{'inputs':>7} {'requests/s':>12} {'batch/s':>12} {'speedup':>8}")
+        for size in args.sizes:
+            separate, batch = time_batch(app, size, args.requests, args.composite)
+            print(f"{size:>7} {args.requests / separate:>12.1f} {args.requests / batch:>12.1f}"
+                  f" {separate / batch:>7.1f}x")
+        return
+    if args.templates:
+        print(f"{'inputs':>7} {'uncached/s':>12} {'cached/s':>12} {'speedup':>8}")
+        for size in args.sizes:
+            uncached, cached = (
+                time_admission(app, size, args.requests, args.composite, cache_size)
+                for cache_size in (0, TEMPLATE_CACHE_SIZE))
+            print(f"{size:>7} {args.requests / uncached:>12.1f} {args.requests / cached:>12.1f}"
+                  f" {uncached / cached:>7.1f}x")
+        return
+    print(f"{'inputs x args':>15} {'seconds':>10} {'us/input':>10}")
+    for size in args.sizes:
+        seconds = time_apply(app, size, args.repeat, args.composite)
+        print(f"{size:>7} x {size:<5} {seconds:>10.4f} {seconds / size * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
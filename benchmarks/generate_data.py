@@ -0,0 +1,191 @@
+"""Generate keypairs and Crypt4GH files of random data for benchmarks.
+
+Writes --keys recipient keypairs (key_<i>.sec/.pub), a writer keypair and --count Crypt4GH files
+(file_<i>.c4gh) of --size bytes each to the output directory. Each file is encrypted for
+--recipients of the recipient keys, assigned round robin. A --foreign fraction of the files is
+encrypted for a key whose secret key is not written instead, so that decryption skips them.
+The layout is recorded in dataset.json.
+
+Usage:
+    python3 benchmarks/generate_data.py --output-dir /tmp/bench [--count 10] [--size 64M]
+        [--keys 2] [--recipients 1] [--foreign 0.0]
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+import io
+import json
+import os
+from pathlib import Path
+
+from crypt4gh.keys import c4gh, get_private_key, get_public_key
+from crypt4gh.lib import SEGMENT_SIZE, encrypt
+
+from crypt4gh_middleware.decrypt import byte_size
+
+DATASET_NAME = "dataset.json"
+
+
+class RandomStream(io.RawIOBase):
+    """Stream of size random bytes that does not hold them in memory."""
+
+    def __init__(self, size: int):
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), SEGMENT_SIZE, self.remaining)
+        buffer[:size] = os.urandom(size)
+        self.remaining -= size
+        return size
+
+
+@dataclass
+class Dataset:
+    """Files written by generate_dataset.
+
+    Attributes:
+        secret_keys: Paths of the secret keys of the recipients.
+        files: Paths of the Crypt4GH files.
+        foreign_files: Paths of the Crypt4GH files none of the secret keys opens.
+        file_size: Size of the plaintext of each file in bytes.
+        recipients: Number of recipients each file is encrypted for.
+    """
+    secret_keys: list[Path] = field(default_factory=list)
+    files: list[Path] = field(default_factory=list)
+    foreign_files: list[Path] = field(default_factory=list)
+    file_size: int = 0
+    recipients: int = 1
+
+    @property
+    def all_files(self) -> list[Path]:
+        """Paths of the secret keys and all Crypt4GH files."""
+        return self.secret_keys + self.files + self.foreign_files
+
+    def save(self, path: Path):
+        """Write the dataset to a JSON file."""
+        path.write_text(json.dumps({
+            "secret_keys": [str(key) for key in self.secret_keys],
+            "files": [str(file_path) for file_path in self.files],
+            "foreign_files": [str(file_path) for file_path in self.foreign_files],
+            "file_size": self.file_size,
+            "recipients": self.recipients,
+        }, indent=2), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: Path) -> "Dataset":
+        """Read a dataset written by save."""
+        fields = json.loads(path.read_text(encoding="utf-8"))
+        return cls(secret_keys=[Path(key) for key in fields["secret_keys"]],
+                   files=[Path(file_path) for file_path in fields["files"]],
+                   foreign_files=[Path(file_path) for file_path in fields["foreign_files"]],
+                   file_size=fields["file_size"], recipients=fields["recipients"])
+
+
+def generate_keypair(directory: Path, name: str) -> tuple[Path, Path]:
+    """Write an unencrypted Crypt4GH keypair and return the paths of its secret and public key."""
+    secret_key, public_key = directory/f"{name}.sec", directory/f"{name}.pub"
+    # c4gh.generate changes the umask of the process to restrict access to the keys
+    umask = os.umask(0o022)
+    try:
+        c4gh.generate(secret_key, public_key)
+    finally:
+        os.umask(umask)
+    return secret_key, public_key
+
+
+@dataclass
+class DatasetSpec:
+    """Parameters of a dataset written by generate_dataset.
+
+    Attributes:
+        count: Number of Crypt4GH files.
+        size: Size of the plaintext of each file in bytes.
+        keys: Number of recipient keypairs.
+        recipients: Number of recipients each file is encrypted for.
+        foreign: Fraction of the files encrypted for a key whose secret key is not written.
+    """
+    count: int = 10
+    size: int = 64 * 1024 * 1024
+    keys: int = 1
+    recipients: int = 1
+    foreign: float = 0.0
+
+
+def _generate_recipients(output_dir: Path, spec: DatasetSpec, dataset: Dataset) -> list[list]:
+    """Write the recipient keypairs and return the public keys each file is encrypted for."""
+    public_keys = []
+    for index in range(spec.keys):
+        secret_key, public_key = generate_keypair(output_dir, f"key_{index}")
+        dataset.secret_keys.append(secret_key)
+        public_keys.append(get_public_key(public_key))
+    foreign_secret_key, foreign_public_key = generate_keypair(output_dir, "foreign")
+    foreign_secret_key.unlink()
+    foreign_count = round(spec.count * spec.foreign)
+    return [[get_public_key(foreign_public_key)] if index < foreign_count else
+            [public_keys[(index + offset) % spec.keys] for offset in range(spec.recipients)]
+            for index in range(spec.count)]
+
+
+def generate_dataset(output_dir: Path, spec: DatasetSpec) -> Dataset:
+    """Write keypairs and Crypt4GH files of random data to a directory.
+
+    Args:
+        output_dir: Directory to write to.
+        spec: Number and size of the files and their recipients.
+
+    Returns:
+        The dataset.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    writer_key = get_private_key(generate_keypair(output_dir, "writer")[0],
+                                 callback=lambda x: "")
+    dataset = Dataset(file_size=spec.size, recipients=spec.recipients)
+    recipients = _generate_recipients(output_dir, spec, dataset)
+    foreign_count = round(spec.count * spec.foreign)
+    for index, file_keys in enumerate(recipients):
+        file_path = output_dir/f"file_{index}.c4gh"
+        (dataset.foreign_files if index < foreign_count else dataset.files).append(file_path)
+        with open(file_path, "wb") as f_out:
+            encrypt(keys=[(0, writer_key, public_key) for public_key in file_keys],
+                    infile=RandomStream(spec.size), outfile=f_out)
+    dataset.save(output_dir/DATASET_NAME)
+    return dataset
+
+
+def add_spec_arguments(parser: ArgumentParser):
+    """Add the options of a DatasetSpec to a parser."""
+    parser.add_argument("--count", type=int, default=10, help="number of Crypt4GH files")
+    parser.add_argument("--size", type=byte_size, default=64 * 1024 * 1024,
+                        help="plaintext size of each file, with an optional K, M or G suffix")
+    parser.add_argument("--keys", type=int, default=1, help="number of recipient keypairs")
+    parser.add_argument("--recipients", type=int, default=1,
+                        help="number of recipients each file is encrypted for")
+    parser.add_argument("--foreign", type=float, default=0.0,
+                        help="fraction of files encrypted for a key that is not provided")
+
+
+def get_spec(parser: ArgumentParser, args) -> DatasetSpec:
+    """Return the DatasetSpec of parsed arguments, exiting if it is invalid."""
+    if not 1 <= args.recipients <= args.keys:
+        parser.error("--recipients must be between 1 and --keys")
+    if not 0.0 <= args.foreign <= 1.0:
+        parser.error("--foreign must be between 0 and 1")
+    return DatasetSpec(count=args.count, size=args.size, keys=args.keys,
+                       recipients=args.recipients, foreign=args.foreign)
+
+
+def main():
+    """Generate a dataset from the command line."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output-dir", type=Path, required=True)
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    dataset = generate_dataset(args.output_dir, get_spec(parser, args))
+    print(f"Wrote {len(dataset.files) + len(dataset.foreign_files)} files and "
+          f"{len(dataset.secret_keys)} keys to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
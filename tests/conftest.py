@@ -1,10 +1,31 @@
 """Shared fixtures for tests."""
 
+import io
+import os
 import shutil
 
+from crypt4gh.keys import get_private_key, get_public_key
+from crypt4gh.lib import encrypt
 import pytest
 
-from tests.utils import INPUT_DIR
+from tests.utils import INPUT_DIR, serve_directory
+
+
+@pytest.fixture(name="files")
+def fixture_files(tmp_path):
+    """Returns list of input file paths."""
+    files = [INPUT_DIR / "hello.txt", INPUT_DIR / "hello.c4gh", INPUT_DIR / "alice.sec"]
+    temp_files = [tmp_path / file.name for file in files]
+    for src, dest in zip(files, temp_files):
+        shutil.copy(src, dest)
+    return temp_files
+
+
+@pytest.fixture(name="output_dir")
+def fixture_output_dir(tmp_path):
+    """Returns an empty output directory."""
+    (tmp_path/"out").mkdir()
+    return tmp_path/"out"
 
 
 @pytest.fixture(name="encrypted_files")
@@ -17,3 +38,33 @@ def fixture_encrypted_files(tmp_path):
     for src, dest in zip(encrypted_files, temp_files):
         shutil.copy(src, dest)
     return temp_files
+
+
+@pytest.fixture(name="alice_keys")
+def fixture_alice_keys():
+    """Returns alice's secret and public key bytes."""
+    return (get_private_key(INPUT_DIR/"alice.sec", callback=lambda x: ''),
+            get_public_key(INPUT_DIR/"alice.pub"))
+
+
+@pytest.fixture(name="make_encrypted_file")
+def fixture_make_encrypted_file(tmp_path, alice_keys):
+    """Returns a function that encrypts random plaintext of a given size for alice.
+
+    Alice's secret key is used as the writer key, so all files share the same writer public key.
+    """
+    def make_encrypted_file(size, name=None):
+        plaintext = os.urandom(size)
+        sk, pk = alice_keys
+        file_path = tmp_path/(name or f"random_{size}.c4gh")
+        with open(file_path, "wb") as f_out:
+            encrypt(keys=[(0, sk, pk)], infile=io.BytesIO(plaintext), outfile=f_out)
+        return file_path, plaintext
+    return make_encrypted_file
+
+
+@pytest.fixture(name="http_server")
+def fixture_http_server(tmp_path):
+    """Returns a local HTTP server with range request support serving tmp_path."""
+    with serve_directory(tmp_path) as server:
+        yield server
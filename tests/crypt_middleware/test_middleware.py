@@ -0,0 +1,625 @@
+"""Tests for middleware.py"""
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+
+import flask
+import pytest
+
+from crypt4gh_middleware.middleware import (
+    DECRYPTION_IMAGE,
+    FIFO_INPUTS_TAG,
+    LAUNCHER_PATH,
+    MANIFEST_PATH,
+    PLAINTEXT_CHECKSUMS_TAG,
+    STAGED_INPUTS_TAG,
+    VOLUME_PATH,
+    CryptMiddleware,
+    EmptyPayloadException,
+    Histogram,
+    InvalidTaskException,
+    MiddlewareMetrics,
+    PathNotAllowedException,
+    PathRewriter,
+    TemplateCache,
+    TemplatePlan,
+)
+
+
+@pytest.fixture(name="app")
+def fixture_app():
+    """Returns a Flask application used to build requests."""
+    return flask.Flask(__name__)
+
+
+@pytest.fixture(name="task_body")
+def fixture_task_body():
+    """Returns a TES task body with a Crypt4GH input, a key and a plain input."""
+    return {
+        "inputs": [
+            {"url": "s3://bucket/hello.c4gh", "path": "/inputs/hello.c4gh", "type": "FILE"},
+            {"url": "s3://bucket/alice.sec", "path": "/inputs/alice.sec", "type": "FILE"},
+            {"url": "s3://bucket/script.py", "path": "/inputs/script.py", "type": "FILE"},
+        ],
+        "outputs": [
+            {"url": "s3://bucket/out.txt", "path": "/outputs/out.txt", "type": "FILE"},
+        ],
+        "executors": [
+            {
+                "image": "python:3",
+                "command": ["python3", "/inputs/script.py", "/inputs/hello.c4gh", "--flag"],
+                "stdin": "/inputs/hello.c4gh",
+                "stdout": "/outputs/out.txt",
+                "workdir": "/inputs/script.py",
+                "env": {"SECRET": "/inputs/alice.sec", "OTHER": "value"},
+            }
+        ],
+        "volumes": [],
+    }
+
+
+def get_manifest(body):
+    """Return the manifest entries passed to the decryption executor of a task body."""
+    manifest_input, = [input_body for input_body in body["inputs"]
+                       if input_body["path"] == MANIFEST_PATH]
+    return [json.loads(line) for line in manifest_input["content"].splitlines()]
+
+
+def apply_middleware(app, task_body, middleware=None):
+    """Apply the middleware to a request carrying task_body and return the resulting body."""
+    with app.test_request_context(json=task_body):
+        return (middleware or CryptMiddleware()).apply_middleware(flask.request).json
+
+
+class TestApplyMiddleware:
+    """Test CryptMiddleware.apply_middleware."""
+
+    def test_command_paths_rewritten(self, app, task_body):
+        """Test that staged input paths in commands are changed to paths in the volume."""
+        body = apply_middleware(app, task_body)
+        assert body["executors"][1]["command"] == [
+            "python3", "/inputs/script.py", f"{VOLUME_PATH}/hello.c4gh", "--flag"]
+
+    def test_composite_arguments_rewritten(self, app, task_body):
+        """Test that input paths embedded in arguments are changed to paths in the volume."""
+        task_body["executors"][0]["command"] = [
+            "bash", "-c", "python3 /inputs/script.py < /inputs/hello.c4gh | wc -l"]
+        body = apply_middleware(app, task_body)
+        assert body["executors"][1]["command"][2] == (
+            f"python3 /inputs/script.py < {VOLUME_PATH}/hello.c4gh | wc -l")
+
+    def test_other_executor_fields_rewritten(self, app, task_body):
+        """Test that input paths in stdin, workdir and env are changed to paths in the volume."""
+        executor = apply_middleware(app, task_body)["executors"][1]
+        assert executor["stdin"] == f"{VOLUME_PATH}/hello.c4gh"
+        assert executor["workdir"] == "/inputs/script.py"
+        assert executor["env"] == {"SECRET": f"{VOLUME_PATH}/alice.sec", "OTHER": "value"}
+        assert executor["stdout"] == "/outputs/out.txt"
+
+    def test_optional_executor_fields(self, app, task_body):
+        """Test that executors without the optional fields are accepted."""
+        for field in ("stdin", "workdir", "env"):
+            del task_body["executors"][0][field]
+        executor = apply_middleware(app, task_body)["executors"][1]
+        assert "stdin" not in executor and "workdir" not in executor and "env" not in executor
+
+    def test_decryption_executor_added(self, app, task_body):
+        """Test that the decryption executor is prepended and reads the manifest."""
+        executor = apply_middleware(app, task_body)["executors"][0]
+        assert executor["command"] == [
+            "python3", "-m", "decrypt", "--manifest", MANIFEST_PATH, "--output-dir", VOLUME_PATH]
+        assert executor["image"] == DECRYPTION_IMAGE
+
+    def test_decryption_image(self, app, task_body):
+        """Test that the image of the decryption executor can be set."""
+        body = apply_middleware(app, task_body, CryptMiddleware(decryption_image="c4gh:dev"))
+        assert body["executors"][0]["image"] == "c4gh:dev"
+
+    def test_manifest_added(self, app, task_body):
+        """Test that the manifest lists the staged inputs with their roles and destinations."""
+        assert get_manifest(apply_middleware(app, task_body)) == [
+            {"path": "/inputs/hello.c4gh", "destination": "hello.c4gh",
+             "role": "ciphertext"},
+            {"path": "/inputs/alice.sec", "destination": "alice.sec",
+             "role": "key"},
+        ]
+
+    def test_command_size_fixed(self, app, task_body):
+        """Test that the decryption command does not grow with the number of inputs."""
+        task_body["inputs"] += [{"url": f"s3://bucket/{i}.c4gh", "path": f"/inputs/{i}.c4gh"}
+                                for i in range(1000)]
+        body = apply_middleware(app, task_body)
+        assert len(body["executors"][0]["command"]) == 7
+        assert len(get_manifest(body)) == 1002
+
+    def test_volume_added(self, app, task_body):
+        """Test that the volume is added to the task."""
+        assert apply_middleware(app, task_body)["volumes"] == [VOLUME_PATH]
+
+    def test_input_in_volume(self, app, task_body):
+        """Test that inputs may not be placed in the volume."""
+        task_body["inputs"][0]["path"] = f"{VOLUME_PATH}/hello.c4gh"
+        with pytest.raises(PathNotAllowedException):
+            apply_middleware(app, task_body)
+
+    def test_volume_in_volumes(self, app, task_body):
+        """Test that the volume may not be requested by the task."""
+        task_body["volumes"] = [VOLUME_PATH]
+        with pytest.raises(PathNotAllowedException):
+            apply_middleware(app, task_body)
+
+    def test_output_is_input(self, app, task_body):
+        """Test that inputs may not be modified in place."""
+        task_body["outputs"][0]["path"] = "/inputs/hello.c4gh"
+        with pytest.raises(PathNotAllowedException):
+            apply_middleware(app, task_body)
+
+    def test_empty_payload(self, app):
+        """Test that a request without a payload is rejected."""
+        with pytest.raises(EmptyPayloadException):
+            apply_middleware(app, {})
+
+    @pytest.mark.parametrize("inputs", [None, []])
+    def test_no_inputs(self, app, inputs):
+        """Test that a task without inputs, which TES allows, is passed through unchanged."""
+        task_body = {
+            "executors": [{"image": "ubuntu", "command": ["touch", "/outputs/out"]}],
+            "outputs": [{"url": "s3://bucket/out", "path": "/outputs/out"}],
+        }
+        if inputs is not None:
+            task_body["inputs"] = inputs
+        expected = copy.deepcopy(task_body)
+        assert apply_middleware(app, task_body) == expected
+        result = CryptMiddleware().apply_batch([copy.deepcopy(task_body)])[0]
+        assert result.error is None
+        assert result.body == expected
+
+
+class TestSelectiveStaging:
+    """Test which inputs CryptMiddleware stages in the volume."""
+
+    @staticmethod
+    def staged_paths(app, task_body):
+        """Return the input paths passed to the decryption executor."""
+        return [entry["path"] for entry in get_manifest(apply_middleware(app, task_body))]
+
+    def test_url_suffix(self, app, task_body):
+        """Test that inputs with a Crypt4GH URL are staged whatever their path."""
+        task_body["inputs"][2]["url"] = "https://example.org/data/script.c4gh?token=x"
+        assert "/inputs/script.py" in self.staged_paths(app, task_body)
+
+    def test_tagged_input(self, app, task_body):
+        """Test that inputs listed in the task tag are staged."""
+        task_body["tags"] = {STAGED_INPUTS_TAG: "/inputs/other, /inputs/script.py"}
+        entry = get_manifest(apply_middleware(app, task_body))[2]
+        assert entry["path"] == "/inputs/script.py"
+        assert "role" not in entry
+
+    def test_inline_private_key(self, app, task_body):
+        """Test that inputs with an armored private key as content are staged."""
+        task_body["inputs"].append({
+            "content": "-----BEGIN CRYPT4GH PRIVATE KEY-----\nAAAA\n", "path": "/inputs/key"})
+        assert get_manifest(apply_middleware(app, task_body))[2] == {
+            "path": "/inputs/key", "destination": "key", "role": "key"}
+
+    def test_inline_plain_content(self, app, task_body):
+        """Test that inputs with other content are not staged."""
+        task_body["inputs"].append({"content": "hello", "path": "/inputs/hello.txt"})
+        assert "/inputs/hello.txt" not in self.staged_paths(app, task_body)
+
+    def test_no_staged_inputs(self, app, task_body):
+        """Test that requests without inputs to stage are left unchanged."""
+        del task_body["inputs"][:2]
+        expected = copy.deepcopy(task_body)
+        assert apply_middleware(app, task_body) == expected
+
+
+class TestStreamURLs:
+    """Test CryptMiddleware with stream_urls."""
+
+    def test_streamed_inputs(self, app, task_body):
+        """Test that Crypt4GH inputs with HTTP(S) URLs are fetched by the decryption executor."""
+        task_body["inputs"][0]["url"] = "https://minio.example.org/bucket/hello.c4gh"
+        body = apply_middleware(app, task_body, CryptMiddleware(stream_urls=True))
+        assert "/inputs/hello.c4gh" not in [input_body["path"] for input_body in body["inputs"]]
+        assert get_manifest(body)[0] == {
+            "url": "https://minio.example.org/bucket/hello.c4gh",
+            "destination": "hello.c4gh", "role": "ciphertext"}
+        assert body["executors"][1]["stdin"] == f"{VOLUME_PATH}/hello.c4gh"
+
+    def test_other_inputs_staged(self, app, task_body):
+        """Test that keys and inputs with other URL schemes are still staged by TES."""
+        body = apply_middleware(app, task_body, CryptMiddleware(stream_urls=True))
+        assert [entry["path"] for entry in get_manifest(body)] == [
+            "/inputs/hello.c4gh", "/inputs/alice.sec"]
+        assert len(body["inputs"]) == 4
+
+    def test_disabled_by_default(self, app, task_body):
+        """Test that inputs are not streamed unless requested."""
+        task_body["inputs"][0]["url"] = "https://minio.example.org/bucket/hello.c4gh"
+        assert "url" not in get_manifest(apply_middleware(app, task_body))[0]
+
+
+class TestFifoInputs:
+    """Test inputs decrypted into named pipes by CryptMiddleware."""
+
+    @pytest.fixture(name="fifo_body")
+    def fixture_fifo_body(self, task_body):
+        """Returns the task body with the Crypt4GH input tagged to be read from a named pipe."""
+        del task_body["executors"][0]["stdin"]
+        task_body["tags"] = {FIFO_INPUTS_TAG: "/inputs/hello.c4gh"}
+        return task_body
+
+    def test_streamed_entry(self, app, fifo_body):
+        """Test that the tagged input is marked to be streamed in the manifest."""
+        assert get_manifest(apply_middleware(app, fifo_body))[0] == {
+            "path": "/inputs/hello.c4gh", "destination": "hello.c4gh",
+            "role": "ciphertext", "stream": True}
+
+    def test_consumer_wrapped(self, app, fifo_body):
+        """Test that executors reading the input are run by the launcher."""
+        fifo_body["executors"].append({"image": "alpine", "command": ["echo", "done"]})
+        body = apply_middleware(app, fifo_body)
+        assert body["executors"][1]["command"] == [
+            "python3", LAUNCHER_PATH, "--manifest", MANIFEST_PATH, "--output-dir", VOLUME_PATH,
+            "--exec", "python3", "/inputs/script.py", f"{VOLUME_PATH}/hello.c4gh", "--flag"]
+        assert body["executors"][2]["command"] == ["echo", "done"]
+
+    def test_env_consumer_wrapped(self, app, fifo_body):
+        """Test that executors referencing the input in their environment are wrapped."""
+        fifo_body["executors"][0]["command"] = ["run"]
+        fifo_body["executors"][0]["env"]["DATA"] = "/inputs/hello.c4gh"
+        assert apply_middleware(app, fifo_body)["executors"][1]["command"][0] == "python3"
+
+    def test_stdin_not_streamed(self, app, task_body):
+        """Test that inputs used as stdin are decrypted on disk."""
+        task_body["tags"] = {FIFO_INPUTS_TAG: "/inputs/hello.c4gh"}
+        body = apply_middleware(app, task_body)
+        assert "stream" not in get_manifest(body)[0]
+        assert body["executors"][1]["command"][:2] == ["python3", "/inputs/script.py"]
+
+
+class TestPlaintextChecksums:
+    """Test passing expected plaintext checksums to the decryption executor."""
+
+    def test_checksum_added(self, app, task_body):
+        """Test that the expected checksum of a Crypt4GH input is added to its entry."""
+        task_body["tags"] = {PLAINTEXT_CHECKSUMS_TAG:
+                             "/inputs/hello.c4gh = sha256:ab12, /inputs/alice.sec=md5:00"}
+        manifest = get_manifest(apply_middleware(app, task_body))
+        assert manifest[0]["plaintext_checksum"] == "sha256:ab12"
+        assert "plaintext_checksum" not in manifest[1]
+
+    def test_fifo_input(self, app, task_body):
+        """Test that inputs decrypted into named pipes get no expected checksum."""
+        del task_body["executors"][0]["stdin"]
+        task_body["tags"] = {FIFO_INPUTS_TAG: "/inputs/hello.c4gh",
+                             PLAINTEXT_CHECKSUMS_TAG: "/inputs/hello.c4gh=sha256:ab12"}
+        assert "plaintext_checksum" not in get_manifest(apply_middleware(app, task_body))[0]
+
+
+class TestTelemetry:
+    """Test the decryption executor telemetry option and the request metrics."""
+
+    def test_telemetry_option(self, app, task_body):
+        """Test that the decryption executor writes telemetry to stdout only if enabled."""
+        assert "--telemetry" not in apply_middleware(app, task_body)["executors"][0]["command"]
+        body = apply_middleware(app, task_body, CryptMiddleware(telemetry=True))
+        assert body["executors"][0]["command"][-2:] == ["--telemetry", "-"]
+
+    def test_histogram_render(self):
+        """Test that values are counted in cumulative buckets of the Prometheus text format."""
+        histogram = Histogram("test_values", "Test values.", [10, 1])
+        for value in [0.5, 1, 5, 20]:
+            histogram.observe(value)
+        assert histogram.render() == (
+            "# HELP test_values Test values.\n"
+            "# TYPE test_values histogram\n"
+            'test_values_bucket{le="1.0"} 2\n'
+            'test_values_bucket{le="10.0"} 3\n'
+            'test_values_bucket{le="+Inf"} 4\n'
+            "test_values_sum 26.5\n"
+            "test_values_count 4\n")
+
+    def test_request_metrics(self, app, task_body):
+        """Test that the latency and input counts of each request are observed."""
+        metrics = MiddlewareMetrics()
+        middleware = CryptMiddleware(metrics=metrics)
+        apply_middleware(app, task_body, middleware)
+        with pytest.raises(EmptyPayloadException):
+            apply_middleware(app, {}, middleware)
+        rendered = metrics.render()
+        assert "crypt4gh_middleware_apply_seconds_count 2\n" in rendered
+        assert 'crypt4gh_middleware_request_inputs_bucket{le="2.0"} 0\n' in rendered
+        assert 'crypt4gh_middleware_request_inputs_bucket{le="5.0"} 1\n' in rendered
+        assert "crypt4gh_middleware_request_inputs_sum 3.0\n" in rendered
+        assert "crypt4gh_middleware_staged_inputs_sum 2.0\n" in rendered
+
+    def test_shared_metrics(self, app, task_body):
+        """Test that observations from concurrent requests are all counted."""
+        middleware = CryptMiddleware()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: apply_middleware(app, copy.deepcopy(task_body),
+                                                         middleware), range(200)))
+        assert "crypt4gh_middleware_apply_seconds_count 200\n" in middleware.metrics.render()
+
+
+class TestTemplateCache:
+    """Test the cache of task template rewrites."""
+
+    @staticmethod
+    def with_urls(task_body, bucket):
+        """Return a copy of task_body whose input URLs point to another bucket."""
+        body = copy.deepcopy(task_body)
+        for input_body in body["inputs"]:
+            input_body["url"] = input_body["url"].replace("bucket", bucket)
+        return body
+
+    @pytest.mark.parametrize("tags, stream_urls", [
+        ({}, False),
+        ({FIFO_INPUTS_TAG: "/inputs/hello.c4gh"}, False),
+        ({PLAINTEXT_CHECKSUMS_TAG: "/inputs/hello.c4gh=sha256:00"}, True),
+    ])
+    def test_hit_matches_rewrite(self, app, task_body, tags, stream_urls):
+        """Test that a request rewritten from the cache equals its uncached rewrite."""
+        task_body["tags"] = tags
+        task_body["inputs"][0]["url"] = "https://bucket/hello.c4gh"
+        middleware = CryptMiddleware(stream_urls=stream_urls)
+        apply_middleware(app, self.with_urls(task_body, "first"), middleware)
+        cached = apply_middleware(app, self.with_urls(task_body, "second"), middleware)
+        uncached = apply_middleware(app, self.with_urls(task_body, "second"),
+                                    CryptMiddleware(stream_urls=stream_urls,
+                                                    template_cache_size=0))
+        assert middleware.templates.hits == 1
+        assert cached == uncached
+        assert "second" in json.dumps(get_manifest(cached)) or not stream_urls
+
+    def test_template_changed(self, app, task_body):
+        """Test that requests with other executors, paths or tags miss the cache."""
+        middleware = CryptMiddleware()
+        apply_middleware(app, copy.deepcopy(task_body), middleware)
+        task_body["executors"][0]["command"].append("--other")
+        apply_middleware(app, copy.deepcopy(task_body), middleware)
+        task_body["inputs"][2]["path"] = "/inputs/other.py"
+        apply_middleware(app, copy.deepcopy(task_body), middleware)
+        task_body["tags"] = {STAGED_INPUTS_TAG: "/inputs/other.py"}
+        body = apply_middleware(app, copy.deepcopy(task_body), middleware)
+        assert (middleware.templates.hits, middleware.templates.misses) == (0, 4)
+        assert [entry["path"] for entry in get_manifest(body)][-1] == "/inputs/other.py"
+
+    def test_requests_isolated(self, app, task_body):
+        """Test that requests rewritten from the same plan do not share executors."""
+        middleware = CryptMiddleware()
+        first = apply_middleware(app, copy.deepcopy(task_body), middleware)
+        first["executors"][1]["command"].clear()
+        second = apply_middleware(app, copy.deepcopy(task_body), middleware)
+        assert second["executors"][1]["command"][2] == f"{VOLUME_PATH}/hello.c4gh"
+
+    def test_unchanged_request(self, app, task_body):
+        """Test that requests without inputs to stage are cached and left unchanged."""
+        task_body["inputs"] = task_body["inputs"][2:]
+        middleware = CryptMiddleware()
+        for _ in range(2):
+            assert apply_middleware(app, copy.deepcopy(task_body), middleware) == task_body
+        assert middleware.templates.hits == 1
+
+    def test_metrics(self, app, task_body):
+        """Test that hits and misses are counted in the metrics."""
+        middleware = CryptMiddleware()
+        for _ in range(3):
+            apply_middleware(app, copy.deepcopy(task_body), middleware)
+        rendered = middleware.metrics.render()
+        assert "crypt4gh_middleware_template_cache_hits_total 2\n" in rendered
+        assert "crypt4gh_middleware_template_cache_misses_total 1\n" in rendered
+        assert "crypt4gh_middleware_staged_inputs_count 3\n" in rendered
+
+    def test_eviction(self):
+        """Test that the least recently used plan is evicted."""
+        cache = TemplateCache(maxsize=2)
+        for key in ["a", "b"]:
+            cache.put(key, TemplatePlan([]))
+        assert cache.get("a") is not None
+        cache.put("c", TemplatePlan([]))
+        assert cache.get("b") is None
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_disabled(self, app, task_body):
+        """Test that a cache size of 0 disables the cache."""
+        middleware = CryptMiddleware(template_cache_size=0)
+        apply_middleware(app, task_body, middleware)
+        assert middleware.templates is None
+
+
+class TestBatch:
+    """Test applying the middleware to batches of task bodies."""
+
+    @staticmethod
+    def make_task_body(index: int) -> dict:
+        """Return a task body of a scatter step reading the files of sample index."""
+        return {
+            "inputs": [{"url": f"s3://bucket/sample_{index}.c4gh", "path": "/inputs/sample.c4gh",
+                        "type": "FILE"},
+                       {"url": "s3://bucket/alice.sec", "path": "/inputs/alice.sec"}],
+            "outputs": [{"url": f"s3://bucket/out_{index}", "path": "/outputs/out"}],
+            "executors": [{"image": "ubuntu", "command": ["cat", "/inputs/sample.c4gh"]}],
+            "volumes": [],
+        }
+
+    def test_matches_requests(self, app):
+        """Test that bodies are rewritten in order as their requests would be."""
+        results = CryptMiddleware().apply_batch([self.make_task_body(i) for i in range(5)])
+        assert all(result.error is None for result in results)
+        for index, result in enumerate(results):
+            assert result.body == apply_middleware(app, self.make_task_body(index))
+
+    def test_shared_template(self):
+        """Test that the rewrite of a template is derived once per batch."""
+        middleware = CryptMiddleware(template_cache_size=0)
+        middleware.apply_batch([self.make_task_body(i) for i in range(5)])
+        rendered = middleware.metrics.render()
+        assert "crypt4gh_middleware_template_cache_hits_total 4\n" in rendered
+        assert "crypt4gh_middleware_apply_seconds_count 5\n" in rendered
+
+    def test_errors(self):
+        """Test that rejected bodies are reported without failing the batch."""
+        in_place = self.make_task_body(1)
+        in_place["outputs"][0]["path"] = "/inputs/sample.c4gh"
+        results = CryptMiddleware().apply_batch(
+            [self.make_task_body(0), in_place, {}, [], {"inputs": [{}]}, self.make_task_body(2)])
+        assert [type(result.error) for result in results] == [
+            type(None), PathNotAllowedException, EmptyPayloadException, EmptyPayloadException,
+            InvalidTaskException, type(None)]
+        assert results[-1].body["executors"][1]["command"] == ["cat", f"{VOLUME_PATH}/sample.c4gh"]
+        assert results[1].body is None
+
+    def test_rejected_body_unchanged(self):
+        """Test that a body rejected by a check is not rewritten."""
+        body = self.make_task_body(0)
+        body["volumes"] = [f"{VOLUME_PATH}/data"]
+        expected = copy.deepcopy(body)
+        error = CryptMiddleware().apply_batch([body])[0].error
+        assert isinstance(error, PathNotAllowedException)
+        assert body == expected
+
+    @pytest.mark.parametrize("field, value", [
+        ("inputs", "/inputs/a.c4gh"),
+        ("inputs", [{"path": 1}]),
+        ("inputs", [{"path": "/inputs/a.c4gh", "url": 1}]),
+        ("executors", [{"image": "ubuntu"}]),
+        ("executors", [{"command": ["cat", 1]}]),
+        ("executors", [{"command": ["cat"], "env": {"A": 1}}]),
+        ("executors", [{"command": ["cat"], "stdin": ["/inputs/a.c4gh"]}]),
+        ("outputs", [{"url": "s3://bucket/out"}]),
+        ("volumes", "/data"),
+        ("tags", {STAGED_INPUTS_TAG: ["/inputs/a"]}),
+    ])
+    def test_malformed_body(self, field, value):
+        """Test that bodies with missing fields or fields of other types are rejected unchanged."""
+        body = self.make_task_body(0)
+        body[field] = value
+        expected = copy.deepcopy(body)
+        error = CryptMiddleware().apply_batch([body])[0].error
+        assert isinstance(error, InvalidTaskException)
+        assert body == expected
+
+    def test_optional_fields(self):
+        """Test that bodies without outputs, volumes and tags are rewritten."""
+        body = self.make_task_body(0)
+        del body["outputs"]
+        body["volumes"] = None
+        result = CryptMiddleware().apply_batch([body])[0]
+        assert result.error is None
+        assert result.body["volumes"] == [VOLUME_PATH]
+
+    @pytest.mark.parametrize("separator, prefix, suffix", [
+        (",", "[", "]"),
+        ("\n", "", "\n"),
+    ])
+    def test_json(self, separator, prefix, suffix):
+        """Test that JSON arrays and NDJSON are read."""
+        data = (prefix + separator.join(json.dumps(self.make_task_body(i)) for i in range(3))
+                + suffix)
+        results = CryptMiddleware().apply_batch_json(data.encode())
+        assert [result.body["outputs"][0]["url"] for result in results] == [
+            f"s3://bucket/out_{i}" for i in range(3)]
+
+    def test_ndjson_stream(self, tmp_path):
+        """Test that invalid lines of an NDJSON file are rejected on their own."""
+        path = tmp_path/"tasks.ndjson"
+        path.write_text(f"{json.dumps(self.make_task_body(0))}\n\n{{invalid\n", encoding="utf-8")
+        with open(path, encoding="utf-8") as stream:
+            results = CryptMiddleware().apply_batch_json(stream)
+        assert len(results) == 2
+        assert results[0].error is None
+        assert isinstance(results[1].error, json.JSONDecodeError)
+
+    def test_invalid_array(self):
+        """Test that an invalid JSON array fails the batch, as its items cannot be told apart."""
+        with pytest.raises(json.JSONDecodeError):
+            CryptMiddleware().apply_batch_json("[{}, {")
+        assert not CryptMiddleware().apply_batch_json(" []")
+        assert not CryptMiddleware().apply_batch_json("")
+
+
+class TestSharedMiddleware:
+    """Test sharing one CryptMiddleware instance between requests."""
+
+    @staticmethod
+    def make_task_body(index: int) -> dict:
+        """Return a task body whose paths are unique to index."""
+        paths = [f"/inputs/task_{index}_{i}.c4gh" for i in range(index % 5 + 1)]
+        return {
+            "inputs": [{"url": f"s3://bucket{path}", "path": path, "type": "FILE"}
+                       for path in paths],
+            "outputs": [{"url": "s3://bucket/out", "path": f"/outputs/{index}", "type": "FILE"}],
+            "executors": [{"image": "ubuntu", "command": ["cat"] + paths}],
+            "volumes": [],
+        }
+
+    def check_isolated(self, index: int, body: dict) -> None:
+        """Check that body only references the paths of the task with the given index."""
+        names = [f"task_{index}_{i}.c4gh" for i in range(index % 5 + 1)]
+        decryption_executor, executor = body["executors"]
+        assert [entry["path"] for entry in get_manifest(body)] == [
+            f"/inputs/{name}" for name in names]
+        assert decryption_executor["command"][4] == MANIFEST_PATH
+        assert executor["command"] == ["cat"] + [f"{VOLUME_PATH}/{name}" for name in names]
+        assert body["volumes"] == [VOLUME_PATH]
+
+    def test_sequential_requests(self, app):
+        """Test that state does not leak between requests handled by the same instance."""
+        middleware = CryptMiddleware()
+        for index in range(10):
+            self.check_isolated(index, apply_middleware(app, self.make_task_body(index),
+                                                         middleware))
+
+    def test_concurrent_requests(self, app):
+        """Test that interleaved requests from many threads are isolated."""
+        middleware = CryptMiddleware()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            bodies = list(executor.map(
+                lambda index: apply_middleware(app, self.make_task_body(index), middleware),
+                range(2000)))
+        for index, body in enumerate(bodies):
+            self.check_isolated(index, body)
+
+
+class TestPathRewriter:
+    """Test PathRewriter."""
+
+    rewrites = {
+        "/inputs/a.bam": "/vol/a.bam",
+        "/inputs/a.bam.bai": "/vol/a.bam.bai",
+        "/inputs/dir": "/vol/dir",
+        "/inputs/b": "/vol/b",
+    }
+
+    @pytest.mark.parametrize("text, expected", [
+        ("/inputs/a.bam", "/vol/a.bam"),
+        ("--in=/inputs/a.bam", "--in=/vol/a.bam"),
+        ("/inputs/a.bam,/inputs/b", "/vol/a.bam,/vol/b"),
+        ("samtools view '/inputs/a.bam' | head", "samtools view '/vol/a.bam' | head"),
+        ("/inputs/a.bam.bai", "/vol/a.bam.bai"),
+        ("/inputs/dir/file.txt", "/vol/dir/file.txt"),
+        ("/inputs/a.bam2", "/inputs/a.bam2"),
+        ("/inputs/bb", "/inputs/bb"),
+        ("/data/inputs/b", "/data/inputs/b"),
+        ("~/inputs/b", "~/inputs/b"),
+        ("inputs/b", "inputs/b"),
+        ("", ""),
+    ])
+    def test_rewrite(self, text, expected):
+        """Test that only whole input paths are rewritten."""
+        assert PathRewriter(self.rewrites).rewrite(text) == expected
+
+    def test_overlapping_paths(self):
+        """Test that overlapping paths are rewritten leftmost-longest."""
+        rewriter = PathRewriter({"/in put": "/vol/in put", "/in put/x y": "/vol/x y",
+                                 "/x y": "/vol/wrong"})
+        assert rewriter.rewrite("/in put/x y z") == "/vol/x y z"
+        assert rewriter.rewrite("a /in put b /x y") == "a /vol/in put b /vol/wrong"
+
+    def test_no_paths(self):
+        """Test that a rewriter without paths returns its input unchanged."""
+        assert PathRewriter({}).rewrite("/inputs/a.bam") == "/inputs/a.bam"
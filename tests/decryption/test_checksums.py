@@ -0,0 +1,251 @@
+"""Tests for the plaintext checksums of decrypt.py"""
+import hashlib
+import json
+import shutil
+import zlib
+from unittest import mock
+
+from crypt4gh.lib import SEGMENT_SIZE
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    CHECKSUM_MANIFEST_NAME,
+    DecryptedFile,
+    DecryptionOptions,
+    FileType,
+    ManifestEntry,
+    ManifestError,
+    PlaintextChecksums,
+    decrypt_files,
+    decrypt_pipelined,
+    decrypt_remote_files,
+    get_checksum_algorithms,
+    main,
+    new_checksum,
+    write_checksum_manifest,
+)
+from tests.utils import INPUT_DIR, INPUT_TEXT, patch_cli
+
+ALGORITHMS = ("sha256", "md5", "crc32")
+
+
+def expected_checksums(plaintext):
+    """Returns the checksums of a plaintext for each of ALGORITHMS."""
+    return {"sha256": hashlib.sha256(plaintext).hexdigest(),
+            "md5": hashlib.md5(plaintext).hexdigest(),
+            "crc32": f"{zlib.crc32(plaintext):08x}"}
+
+
+class TestPlaintextChecksums:
+    """Test new_checksum, PlaintextChecksums and get_checksum_algorithms."""
+
+    @pytest.mark.parametrize("algorithm", ALGORITHMS)
+    def test_new_checksum(self, algorithm):
+        """Test that checksums match those of hashlib and zlib."""
+        checksum = new_checksum(algorithm)
+        checksum.update(b"hello ")
+        checksum.update(memoryview(b"world"))
+        assert checksum.hexdigest() == expected_checksums(b"hello world")[algorithm]
+
+    def test_unsupported_algorithm(self):
+        """Test that an error is raised for unsupported algorithms."""
+        with pytest.raises(ValueError):
+            new_checksum("unknown")
+
+    def test_wrap(self):
+        """Test that written data is added to every checksum."""
+        written = []
+        checksums = PlaintextChecksums(ALGORITHMS)
+        write = checksums.wrap(lambda data: written.append(bytes(data)) or len(data))
+        assert write(b"hello ") + write(b"world") == 11
+        assert written == [b"hello ", b"world"]
+        assert checksums.hexdigests() == expected_checksums(b"hello world")
+
+    def test_wrap_without_algorithms(self):
+        """Test that the write function is returned unchanged without algorithms."""
+        assert PlaintextChecksums(()).wrap(print) is print
+
+    @pytest.mark.parametrize("expected, algorithms", [
+        (None, ("md5",)), ("md5:00", ("md5",)), ("sha256:00", ("md5", "sha256"))])
+    def test_get_checksum_algorithms(self, expected, algorithms):
+        """Test that the algorithm of the expected checksum is added to the options."""
+        assert get_checksum_algorithms(DecryptionOptions(checksums=("md5",)),
+                                       expected) == algorithms
+
+
+class TestDecryptFilesChecksums:
+    """Test checksumming the plaintext in decrypt_files."""
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    @pytest.mark.parametrize("in_place", [False, True])
+    def test_checksums(self, make_encrypted_file, alice_keys, jobs, in_place):
+        """Test that the checksums and sizes of the plaintext are returned."""
+        files = [make_encrypted_file(size) for size in (0, 3 * SEGMENT_SIZE + 7)]
+        with mock.patch("crypt4gh_middleware.decrypt.SEGMENT_PARALLEL_THRESHOLD", 0):
+            decrypted_files = decrypt_files(
+                [file_path for file_path, _ in files], [alice_keys[0]], jobs=jobs,
+                options=DecryptionOptions(in_place=in_place, checksums=ALGORITHMS))
+        assert decrypted_files == [
+            DecryptedFile(path=file_path, size=len(plaintext),
+                          checksums=expected_checksums(plaintext))
+            for file_path, plaintext in files]
+
+    def test_byte_ranges(self, make_encrypted_file, alice_keys):
+        """Test that the checksums cover the decrypted byte ranges."""
+        file_path, plaintext = make_encrypted_file(3 * SEGMENT_SIZE)
+        decrypted_file, = decrypt_files([file_path], [alice_keys[0]], options=DecryptionOptions(
+            byte_ranges=((10, 20), (SEGMENT_SIZE, None)), checksums=("sha256",)))
+        selected = plaintext[10:20] + plaintext[SEGMENT_SIZE:]
+        assert decrypted_file.checksums == {"sha256": hashlib.sha256(selected).hexdigest()}
+        assert decrypted_file.size == len(selected)
+
+    def test_without_checksums(self, make_encrypted_file, alice_keys):
+        """Test that no checksums are computed unless requested or expected."""
+        file_path, plaintext = make_encrypted_file(1000)
+        assert decrypt_files([file_path], [alice_keys[0]]) == [
+            DecryptedFile(path=file_path, size=len(plaintext), checksums={})]
+
+    def test_expected_checksum(self, make_encrypted_file, alice_keys):
+        """Test that the expected checksum of the plaintext is computed and checked."""
+        file_path, plaintext = make_encrypted_file(1000)
+        decrypted_file, = decrypt_files(
+            [file_path], [alice_keys[0]],
+            expected_checksums={file_path: f"md5:{hashlib.md5(plaintext).hexdigest().upper()}"})
+        assert decrypted_file.checksums == {"md5": hashlib.md5(plaintext).hexdigest()}
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_mismatch_fails_fast(self, make_encrypted_file, alice_keys, jobs):
+        """Test that a mismatch is raised before the following files are decrypted."""
+        files = [make_encrypted_file(1000, name=f"{i}.c4gh") for i in range(3)]
+        ciphertext = files[2][0].read_bytes()
+        with (mock.patch("concurrent.futures.ProcessPoolExecutor",
+                         return_value=_SerialExecutor()),
+              pytest.raises(ManifestError, match="crc32")):
+            decrypt_files([file_path for file_path, _ in files], [alice_keys[0]], jobs=jobs,
+                          expected_checksums={files[1][0]: "crc32:00000000"})
+        assert files[0][0].read_bytes() == files[0][1]
+        assert files[2][0].read_bytes() == ciphertext
+
+
+class _SerialExecutor:
+    """Executor that runs each task once its result is requested, in submission order."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        """Return a future that runs fn when its result is requested."""
+        return mock.Mock(result=lambda: fn(*args))
+
+    def shutdown(self, **kwargs):
+        """Do nothing, as no task runs ahead."""
+
+
+class TestChecksumsElsewhere:
+    """Test checksumming the plaintext in decrypt_pipelined and decrypt_remote_files."""
+
+    def test_pipelined(self, make_encrypted_file, alice_keys, tmp_path, output_dir):
+        """Test that the pipeline checksums the plaintext and checks the expected checksum."""
+        file_path, plaintext = make_encrypted_file(5 * SEGMENT_SIZE)
+        (tmp_path/"src").mkdir()
+        shutil.move(file_path, tmp_path/"src"/file_path.name)
+        entry = ManifestEntry(
+            path=tmp_path/"src"/file_path.name, destination=output_dir/file_path.name,
+            file_type=FileType.CRYPT4GH,
+            plaintext_checksum=f"sha256:{hashlib.sha256(plaintext).hexdigest()}")
+        assert decrypt_pipelined([entry], [alice_keys[0]], jobs=2, options=DecryptionOptions(
+            checksums=("crc32",))) == [DecryptedFile(
+                path=entry.destination, size=len(plaintext),
+                checksums={key: value for key, value in expected_checksums(plaintext).items()
+                           if key in ("crc32", "sha256")})]
+
+    def test_pipelined_mismatch(self, make_encrypted_file, alice_keys, tmp_path, output_dir):
+        """Test that the pipeline fails if the plaintext does not match."""
+        file_path, _ = make_encrypted_file(1000)
+        (tmp_path/"src").mkdir()
+        shutil.move(file_path, tmp_path/"src"/file_path.name)
+        entry = ManifestEntry(path=tmp_path/"src"/file_path.name,
+                              destination=output_dir/file_path.name,
+                              file_type=FileType.CRYPT4GH, plaintext_checksum="md5:00")
+        with pytest.raises(ManifestError):
+            decrypt_pipelined([entry], [alice_keys[0]])
+
+    def test_remote(self, http_server, make_encrypted_file, alice_keys, output_dir):
+        """Test that large remote files are fetched in one pass when they are checksummed."""
+        file_path, plaintext = make_encrypted_file(10 * SEGMENT_SIZE)
+        entry = ManifestEntry(path=None, destination=output_dir/file_path.name,
+                              file_type=FileType.CRYPT4GH,
+                              url=f"{http_server.url}/{file_path.name}",
+                              plaintext_checksum=f"md5:{hashlib.md5(plaintext).hexdigest()}")
+        with mock.patch("crypt4gh_middleware.decrypt.SEGMENT_PARALLEL_THRESHOLD", 0):
+            decrypted_file, = decrypt_remote_files([entry], [alice_keys[0]], jobs=4)
+        assert decrypted_file.checksums == {"md5": hashlib.md5(plaintext).hexdigest()}
+        assert entry.destination.read_bytes() == plaintext
+        assert http_server.requests == 1
+
+
+def test_write_checksum_manifest(tmp_path):
+    """Test that only files with checksums are listed with their source."""
+    manifest_path = write_checksum_manifest(tmp_path, [
+        DecryptedFile(path=tmp_path/"a", size=1, checksums={"md5": "00"}),
+        DecryptedFile(path=tmp_path/"b", size=2, checksums={}),
+    ], {tmp_path/"a": "/inputs/a.c4gh"})
+    assert manifest_path == tmp_path/CHECKSUM_MANIFEST_NAME
+    assert json.loads(manifest_path.read_text(encoding="utf-8")) == [
+        {"path": str(tmp_path/"a"), "size": 1, "checksums": {"md5": "00"},
+         "source": "/inputs/a.c4gh"}]
+
+
+@pytest.fixture(name="manifest_path")
+def fixture_manifest_path(tmp_path):
+    """Returns a function that writes a manifest of hello.c4gh and alice.sec with the given
+    plaintext checksum."""
+    def manifest_path(plaintext_checksum):
+        for name in ["hello.c4gh", "alice.sec"]:
+            shutil.copy(INPUT_DIR/name, tmp_path/name)
+        path = tmp_path/"manifest.ndjson"
+        path.write_text(
+            json.dumps({"path": str(tmp_path/"hello.c4gh"), "role": "ciphertext",
+                        "plaintext_checksum": plaintext_checksum}) + "\n"
+            + json.dumps({"path": str(tmp_path/"alice.sec"), "role": "key"}) + "\n",
+            encoding="utf-8")
+        return path
+    return manifest_path
+
+
+@pytest.mark.parametrize("pipeline", [[], ["--pipeline"]])
+def test_checksum_manifest_written(manifest_path, tmp_path, output_dir, pipeline):
+    """Test that the checksum manifest is written to the output directory."""
+    plaintext = INPUT_TEXT.encode()
+    path = manifest_path(f"sha256:{hashlib.sha256(plaintext).hexdigest()}")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--checksum", "crc32",
+                    "--manifest", str(path)] + pipeline):
+        main()
+    assert json.loads((output_dir/CHECKSUM_MANIFEST_NAME).read_text(encoding="utf-8")) == [{
+        "path": str(output_dir/"hello.c4gh"), "size": len(plaintext),
+        "checksums": {"crc32": f"{zlib.crc32(plaintext):08x}",
+                      "sha256": hashlib.sha256(plaintext).hexdigest()},
+        "source": str(tmp_path/"hello.c4gh")}]
+
+
+def test_checksum_manifest_of_file_paths(encrypted_files, tmp_path, output_dir):
+    """Test that the sources of files given by path are their original paths."""
+    shutil.copy(INPUT_DIR/"alice.sec", tmp_path/"alice.sec")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--checksum", "md5",
+                    str(encrypted_files[0]), str(tmp_path/"alice.sec")]):
+        main()
+    entry, = json.loads((output_dir/CHECKSUM_MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert entry["source"] == str(encrypted_files[0])
+    assert entry["checksums"] == {"md5": hashlib.md5(INPUT_TEXT.encode()).hexdigest()}
+
+
+def test_checksum_mismatch(manifest_path, output_dir):
+    """Test that decryption fails and the output directory is wiped on a mismatch."""
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                     "--manifest", str(manifest_path("sha256:00"))]),
+          pytest.raises(ManifestError)):
+        main()
+    assert not any(output_dir.iterdir())
@@ -4,11 +4,13 @@ import logging
 import os
 from pathlib import Path
 import shutil
+import sys
 from unittest import mock
 
 import pytest
 
-from crypt4gh_middleware.decrypt import main
+from crypt4gh_middleware.decrypt import InterruptedDecryptionError, main
+from crypt4gh_middleware.middleware import MANIFEST_PATH, CryptMiddleware
 from tests.utils import INPUT_DIR, INPUT_TEXT, patch_cli
 
 
@@ -44,6 +46,108 @@ def test_decryption(encrypted_files, string_paths, tmp_path):
         assert files_decrypted_successfully(encrypted_files=encrypted_files, tmp_path=tmp_path)
 
 
+def test_decryption_with_manifest(encrypted_files, secret_keys, tmp_path):
+    """Test that files listed in a manifest are decrypted successfully."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(
+        "".join(f'{{"path": "{f}", "role": "ciphertext"}}\n' for f in encrypted_files)
+        + "".join(f'{{"path": "{f}", "role": "key"}}\n' for f in secret_keys),
+        encoding="utf-8")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                    "--manifest", str(manifest_path)]):
+        main()
+        assert files_decrypted_successfully(encrypted_files=[f.name for f in encrypted_files],
+                                            tmp_path=output_dir)
+
+
+def test_decryption_with_middleware_manifest(encrypted_files, secret_keys, tmp_path):
+    """Test that the manifest written by the middleware is decrypted into any output directory."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    body = {"inputs": [{"path": str(f)} for f in encrypted_files + secret_keys],
+            "executors": [{"image": "ubuntu", "command": ["cat", str(encrypted_files[0])]}]}
+    body, = [result.body for result in CryptMiddleware().apply_batch([body])]
+    manifest_input, = [input_body for input_body in body["inputs"]
+                       if input_body["path"] == MANIFEST_PATH]
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(manifest_input["content"], encoding="utf-8")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                    "--manifest", str(manifest_path)]):
+        main()
+        assert files_decrypted_successfully(encrypted_files=[f.name for f in encrypted_files],
+                                            tmp_path=output_dir)
+
+
+def test_pipelined_decryption(encrypted_files, string_paths, tmp_path):
+    """Test that files are decrypted successfully in a pipeline."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--pipeline",
+                    "--pipeline-buffer", "1M"] + string_paths):
+        main()
+        assert files_decrypted_successfully(encrypted_files=[f.name for f in encrypted_files],
+                                            tmp_path=output_dir)
+
+
+def test_pipelined_decryption_with_manifest(encrypted_files, secret_keys, tmp_path):
+    """Test that files listed in a manifest are decrypted successfully in a pipeline."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(
+        "".join(f'{{"path": "{f}", "role": "ciphertext"}}\n' for f in encrypted_files)
+        + "".join(f'{{"path": "{f}", "role": "key"}}\n' for f in secret_keys),
+        encoding="utf-8")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--pipeline",
+                    "--manifest", str(manifest_path)]):
+        main()
+        assert files_decrypted_successfully(encrypted_files=[f.name for f in encrypted_files],
+                                            tmp_path=output_dir)
+
+
+def test_decryption_from_url(encrypted_files, secret_keys, http_server, tmp_path):
+    """Test that remote files listed in a manifest are fetched and decrypted successfully."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(
+        "".join(f'{{"url": "{http_server.url}/{f.name}"}}\n' for f in encrypted_files[:2])
+        + f'{{"path": "{secret_keys[0]}", "role": "key"}}\n',
+        encoding="utf-8")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                    "--manifest", str(manifest_path)]):
+        main()
+        assert files_decrypted_successfully(
+            encrypted_files=[f.name for f in encrypted_files[:2]], tmp_path=output_dir)
+        assert all(f.exists() for f in encrypted_files)
+
+
+def test_decryption_into_fifos(encrypted_files, secret_keys, tmp_path):
+    """Test that streamed files are decrypted into named pipes while a command reads them."""
+    output_dir = tmp_path/"out"
+    output_dir.mkdir()
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(
+        f'{{"path": "{encrypted_files[0]}", "role": "ciphertext", "stream": true}}\n'
+        f'{{"path": "{secret_keys[0]}", "role": "key"}}\n',
+        encoding="utf-8")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                    "--manifest", str(manifest_path)]):
+        main()
+    assert (output_dir/".decrypt.py").exists()
+    copy_path = tmp_path/"copy.txt"
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir),
+                     "--manifest", str(manifest_path), "--exec", sys.executable, "-c",
+                     f"open('{copy_path}', 'wb').write("
+                     f"open('{output_dir/encrypted_files[0].name}', 'rb').read())"]),
+          pytest.raises(SystemExit) as exc_info):
+        main()
+    assert exc_info.value.code == 0
+    assert copy_path.read_text(encoding="utf-8") == INPUT_TEXT
+
+
 def test_default_dir(encrypted_files, string_paths, tmp_path):
     """Test that $TMPDIR is used when no output dir is provided."""
     with (patch_cli(["decrypt.py"] + string_paths),
@@ -92,6 +196,55 @@ def test_one_sk_provided(encrypted_files, caplog, secret_keys):
         assert f"Private key for {encrypted_files[2].name} not provided" in caplog.text
 
 
+@pytest.mark.parametrize("jobs", ["1", "3"])
+def test_decryption_with_jobs(encrypted_files, string_paths, tmp_path, jobs):
+    """Test that files are decrypted successfully with different numbers of jobs."""
+    with patch_cli(["decrypt.py", "--output-dir", str(tmp_path), "--jobs", jobs] + string_paths):
+        main()
+        assert files_decrypted_successfully(encrypted_files=encrypted_files, tmp_path=tmp_path)
+
+
+def test_one_sk_provided_with_jobs(encrypted_files, caplog, secret_keys, tmp_path):
+    """Test that missing keys are reported when files are decrypted concurrently."""
+    output_dir = tmp_path/"output"
+    output_dir.mkdir()
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--jobs", "3"]
+                    + [str(f) for f in (encrypted_files + [secret_keys[0]])]),
+          caplog.at_level(logging.CRITICAL)):
+        main()
+        assert f"Private key for {encrypted_files[2].name} not provided" in caplog.text
+
+
+def test_no_files_in_output_dir_on_worker_exception(string_paths, tmp_path):
+    """Test that the output directory is cleaned up when a decryption worker fails."""
+    output_dir = tmp_path/"output"
+    output_dir.mkdir()
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--jobs", "2"] + string_paths),
+          mock.patch("crypt4gh_middleware.decrypt.SegmentBuffers.decrypt",
+                     side_effect=OSError("disk full")),
+          pytest.raises(OSError)):
+        main()
+    assert not any(output_dir.iterdir())
+
+
+def test_in_place_decryption(encrypted_files, string_paths, tmp_path):
+    """Test that files are decrypted successfully in place."""
+    with patch_cli(["decrypt.py", "--output-dir", str(tmp_path), "--in-place"] + string_paths):
+        main()
+        assert files_decrypted_successfully(encrypted_files=encrypted_files, tmp_path=tmp_path)
+
+
+def test_interrupted_in_place_decryption(string_paths, tmp_path):
+    """Test that a journal left by an interrupted in-place decryption fails the run."""
+    output_dir = tmp_path/"output"
+    output_dir.mkdir()
+    (output_dir/".hello.c4gh.c4gh-journal").write_text("{}", encoding="utf-8")
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir)] + string_paths),
+          pytest.raises(InterruptedDecryptionError)):
+        main()
+    assert not any(output_dir.iterdir())
+
+
 def test_invalid_output_dir(string_paths):
     """Test that an exception occurs when an invalid output directory is provided."""
     with (patch_cli(["decrypt.py", "--output-dir", "bad_dir"] + string_paths),
@@ -0,0 +1,181 @@
+"""Tests for the memory use of decrypt.py"""
+import io
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+from unittest import mock
+
+from crypt4gh.lib import CIPHER_SEGMENT_SIZE, SEGMENT_SIZE, encrypt
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    PIPELINE_CHUNK_SIZE,
+    SEGMENT_BUFFERS_SIZE,
+    DecryptionOptions,
+    FileType,
+    KeyIndex,
+    LazyModule,
+    ManifestEntry,
+    SegmentBuffers,
+    byte_size,
+    decrypt_files,
+    decrypt_pipelined,
+)
+from tests.utils import INPUT_DIR
+
+DECRYPT_SCRIPT = Path(__file__).parents[2]/"crypt4gh_middleware"/"decrypt.py"
+# Largest file of test_peak_rss_flat, set to e.g. 10G to check the memory use on large files
+RSS_TEST_MAX_SIZE = os.environ.get("CRYPT4GH_RSS_TEST_MAX_SIZE", str(64 * 1024 * 1024))
+RSS_TOLERANCE = 16 * 1024 * 1024
+
+
+class ZeroStream(io.RawIOBase):
+    """Stream of size zero bytes that does not hold them in memory."""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.zeros = bytes(SEGMENT_SIZE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.zeros), self.remaining)
+        buffer[:size] = self.zeros[:size]
+        self.remaining -= size
+        return size
+
+
+def _decrypt_peak_rss(file_path, output_dir, extra_args):
+    """Decrypt a file with decrypt.py in a new process and return its peak RSS in bytes."""
+    shutil.copy(INPUT_DIR/"alice.sec", file_path.parent/"alice.sec")
+    with subprocess.Popen([sys.executable, str(DECRYPT_SCRIPT), "--output-dir", str(output_dir),
+                           "--jobs", "1", *extra_args, str(file_path),
+                           str(file_path.parent/"alice.sec")]) as process:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    assert process.returncode == 0
+    # ru_maxrss is in kilobytes on Linux
+    return rusage.ru_maxrss * 1024
+
+
+@pytest.fixture(name="decrypted_header")
+def fixture_decrypted_header(make_encrypted_file, alice_keys):
+    """Returns a function that encrypts a file and returns its path, plaintext and header."""
+    def decrypted_header(size):
+        file_path, plaintext = make_encrypted_file(size)
+        return file_path, plaintext, KeyIndex([alice_keys[0]]).resolve_header(file_path)
+    return decrypted_header
+
+
+class TestSegmentBuffers:
+    """Test decrypting segments into preallocated buffers."""
+
+    @pytest.fixture(autouse=True, params=["sodium", "bindings"])
+    def fixture_bindings(self, request):
+        """Runs each test with PyNaCl's private cffi module and without it."""
+        if request.param == "sodium":
+            yield
+            return
+        with mock.patch("crypt4gh_middleware.decrypt.sodium", LazyModule("nacl._missing")):
+            yield
+
+    @pytest.mark.parametrize("segment_count", [1, 3])
+    def test_decrypt(self, decrypted_header, segment_count):
+        """Test that consecutive segments are decrypted into the same buffers."""
+        file_path, plaintext, crypt_header = decrypted_header(4 * SEGMENT_SIZE + 10)
+        buffers = SegmentBuffers(segment_count)
+        decrypted = b""
+        with open(file_path, "rb") as f_in:
+            f_in.seek(crypt_header.data_offset)
+            while size := buffers.read(f_in):
+                decrypted += buffers.decrypt(size, crypt_header.session_keys)
+        assert decrypted == plaintext
+        assert len(buffers.ciphertext) == segment_count * CIPHER_SEGMENT_SIZE
+
+    def test_short_reads(self, decrypted_header):
+        """Test that the buffer is filled from streams returning fewer bytes than asked for."""
+        file_path, plaintext, crypt_header = decrypted_header(SEGMENT_SIZE)
+        data = io.BytesIO(file_path.read_bytes()[crypt_header.data_offset:])
+        f_in = mock.Mock(readinto=lambda buffer: data.readinto(buffer[:1000]))
+        buffers = SegmentBuffers()
+        assert buffers.read(f_in) == CIPHER_SEGMENT_SIZE
+        assert buffers.decrypt(CIPHER_SEGMENT_SIZE, crypt_header.session_keys) == plaintext
+
+    def test_session_keys(self, decrypted_header):
+        """Test that each session key is tried in turn."""
+        file_path, plaintext, crypt_header = decrypted_header(10)
+        buffers = SegmentBuffers()
+        with open(file_path, "rb") as f_in:
+            f_in.seek(crypt_header.data_offset)
+            size = buffers.read(f_in)
+        assert buffers.decrypt(size, [bytes(32)] + crypt_header.session_keys) == plaintext
+
+    @pytest.mark.parametrize("tamper", [-1, 0])
+    def test_authentication_failure(self, decrypted_header, tamper):
+        """Test that a tampered or truncated segment raises an error."""
+        file_path, _, crypt_header = decrypted_header(10)
+        buffers = SegmentBuffers()
+        with open(file_path, "rb") as f_in:
+            f_in.seek(crypt_header.data_offset)
+            size = buffers.read(f_in)
+        buffers.ciphertext[tamper % size] ^= 0xFF
+        with pytest.raises(ValueError):
+            buffers.decrypt(size, crypt_header.session_keys)
+        with pytest.raises(ValueError):
+            buffers.decrypt(20, crypt_header.session_keys)
+
+
+class TestMemoryBudget:
+    """Test capping the memory held in buffers."""
+
+    @pytest.mark.parametrize("memory_budget, expected", [
+        (None, 8), (1, 1), (3 * SEGMENT_BUFFERS_SIZE, 3), (100 * SEGMENT_BUFFERS_SIZE, 8)])
+    def test_limit_jobs(self, memory_budget, expected):
+        """Test that the number of jobs is capped by the budget but is at least one."""
+        options = DecryptionOptions(memory_budget=memory_budget)
+        assert options.limit_jobs(8, SEGMENT_BUFFERS_SIZE) == expected
+
+    def test_decrypt_files(self, make_encrypted_file, alice_keys):
+        """Test that fewer files are decrypted concurrently when the budget is small."""
+        file_paths, plaintexts = zip(*(make_encrypted_file(1000, name=f"{i}.c4gh")
+                                       for i in range(3)))
+        with mock.patch("concurrent.futures.ProcessPoolExecutor") as executor:
+            decrypt_files(file_paths=list(file_paths), private_keys=[alice_keys[0]], jobs=3,
+                          options=DecryptionOptions(memory_budget=SEGMENT_BUFFERS_SIZE))
+        executor.assert_not_called()
+        for file_path, plaintext in zip(file_paths, plaintexts):
+            assert file_path.read_bytes() == plaintext
+
+    def test_decrypt_pipelined(self, make_encrypted_file, alice_keys, output_dir):
+        """Test that the pipeline allocates its chunk buffers once, within the budget."""
+        file_path, plaintext = make_encrypted_file(100 * SEGMENT_SIZE)
+        entry = ManifestEntry(path=file_path, destination=output_dir/file_path.name,
+                              file_type=FileType.CRYPT4GH)
+        chunk_buffers_size = PIPELINE_CHUNK_SIZE // CIPHER_SEGMENT_SIZE * SEGMENT_BUFFERS_SIZE
+        with mock.patch("crypt4gh_middleware.decrypt.SegmentBuffers",
+                        wraps=SegmentBuffers) as segment_buffers:
+            decrypt_pipelined([entry], [alice_keys[0]], jobs=2,
+                              options=DecryptionOptions(memory_budget=2 * chunk_buffers_size))
+        assert entry.destination.read_bytes() == plaintext
+        assert segment_buffers.call_count == 2
+
+
+@pytest.mark.parametrize("extra_args", [[], ["--pipeline"], ["--in-place"]])
+def test_peak_rss_flat(tmp_path, alice_keys, extra_args):
+    """Test that the peak RSS of decrypt.py does not grow with the size of the file."""
+    peak_rss = []
+    for size in [1024 * 1024, byte_size(RSS_TEST_MAX_SIZE)]:
+        file_path = tmp_path/f"{size}"/"zeros.c4gh"
+        file_path.parent.mkdir()
+        with open(file_path, "wb") as f_out:
+            encrypt(keys=[(0, *alice_keys)], infile=ZeroStream(size), outfile=f_out)
+        output_dir = tmp_path/f"{size}"/"out"
+        output_dir.mkdir()
+        peak_rss.append(_decrypt_peak_rss(file_path, output_dir,
+                                          ["--memory-budget", "4M", *extra_args]))
+        assert (output_dir/"zeros.c4gh").stat().st_size == size
+        shutil.rmtree(file_path.parent)
+    assert peak_rss[1] - peak_rss[0] < RSS_TOLERANCE
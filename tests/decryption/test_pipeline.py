@@ -0,0 +1,145 @@
+"""Tests for the pipelined decryption in decrypt.py"""
+import json
+import shutil
+from unittest import mock
+
+from crypt4gh.lib import CIPHER_SEGMENT_SIZE, SEGMENT_SIZE
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    PIPELINE_CHUNK_SIZE,
+    DecryptionOptions,
+    FileType,
+    ManifestEntry,
+    ManifestError,
+    decrypt_pipelined,
+    defer_ciphertext_files,
+    stage_file,
+    stage_manifest,
+)
+from tests.utils import INPUT_DIR
+
+
+@pytest.fixture(name="source_dir")
+def fixture_source_dir(tmp_path):
+    """Returns an empty directory for the files to stage."""
+    (tmp_path/"src").mkdir()
+    return tmp_path/"src"
+
+
+@pytest.fixture(name="make_entries")
+def fixture_make_entries(make_encrypted_file, source_dir, output_dir):
+    """Returns a function that encrypts files of the given sizes and returns their entries and
+    plaintexts."""
+    def make_entries(*sizes):
+        entries = []
+        plaintexts = []
+        for size in sizes:
+            file_path, plaintext = make_encrypted_file(size)
+            shutil.move(file_path, source_dir/file_path.name)
+            entries.append(ManifestEntry(path=source_dir/file_path.name,
+                                         destination=output_dir/file_path.name,
+                                         file_type=FileType.CRYPT4GH))
+            plaintexts.append(plaintext)
+        return entries, plaintexts
+    return make_entries
+
+
+class TestDecryptPipelined:
+    """Test decrypt_pipelined."""
+
+    @pytest.mark.parametrize("jobs", [1, 4])
+    @pytest.mark.parametrize("buffer_size", [1, 4 * PIPELINE_CHUNK_SIZE])
+    def test_decrypt(self, make_entries, alice_keys, jobs, buffer_size):
+        """Test that files are staged and decrypted whatever the buffer size."""
+        entries, plaintexts = make_entries(0, 1000, 50 * SEGMENT_SIZE + 5)
+        decrypt_pipelined(entries, [alice_keys[0]], jobs=jobs, buffer_size=buffer_size)
+        for entry, plaintext in zip(entries, plaintexts):
+            assert entry.destination.read_bytes() == plaintext
+            assert not entry.path.exists()
+        assert sorted(entries[0].destination.parent.iterdir()) == sorted(
+            entry.destination for entry in entries)
+
+    def test_stages_overlap(self, make_entries, alice_keys):
+        """Test that the next file is staged before the previous one is synced."""
+        entries, _ = make_entries(4 * 1024 * 1024, 10)
+        events = []
+        with (mock.patch("crypt4gh_middleware.decrypt.stage_file",
+                         side_effect=lambda src, dest: events.append(("stage", src.name))
+                         or stage_file(src, dest)),
+              mock.patch("crypt4gh_middleware.decrypt._sync_file",
+                         side_effect=lambda path: events.append(("sync", path.name)))):
+            decrypt_pipelined(entries, [alice_keys[0]], jobs=2)
+        first, second = (entry.destination.name for entry in entries)
+        assert events.index(("stage", second)) < events.index(("sync", first))
+        assert events[-1] == ("sync", second)
+
+    def test_options(self, make_entries, alice_keys):
+        """Test that byte ranges and in-place decryption are applied."""
+        entries, plaintexts = make_entries(3 * SEGMENT_SIZE)
+        decrypt_pipelined(entries, [alice_keys[0]],
+                          options=DecryptionOptions(in_place=True, byte_ranges=((10, 20),)))
+        assert entries[0].destination.read_bytes() == plaintexts[0][10:20]
+
+    def test_key_not_provided(self, make_entries, caplog):
+        """Test that files without a matching key are staged unchanged."""
+        entries, _ = make_entries(1000)
+        ciphertext = entries[0].path.read_bytes()
+        decrypt_pipelined(entries, [])
+        assert entries[0].destination.read_bytes() == ciphertext
+        assert "not provided" in caplog.text
+
+    def test_mac_failure(self, make_entries, alice_keys):
+        """Test that a tampered segment fails the pipeline and leaves the file encrypted."""
+        entries, _ = make_entries(4 * SEGMENT_SIZE, 10)
+        ciphertext = bytearray(entries[0].path.read_bytes())
+        ciphertext[-2 * CIPHER_SEGMENT_SIZE] ^= 0xFF
+        entries[0].path.write_bytes(ciphertext)
+        with pytest.raises(ValueError):
+            decrypt_pipelined(entries, [alice_keys[0]], jobs=2)
+        assert entries[0].destination.read_bytes() == ciphertext
+        assert not list(entries[0].destination.parent.glob(".*"))
+
+    def test_size_mismatch(self, make_entries, alice_keys):
+        """Test that a file that does not match its entry fails the pipeline."""
+        entries, _ = make_entries(10)
+        entries[0] = ManifestEntry(path=entries[0].path, destination=entries[0].destination,
+                                   file_type=FileType.CRYPT4GH, size=1)
+        with pytest.raises(ManifestError):
+            decrypt_pipelined(entries, [alice_keys[0]])
+
+
+class TestDeferCiphertext:
+    """Test leaving Crypt4GH files to be staged by decrypt_pipelined."""
+
+    @pytest.fixture(name="source_files")
+    def fixture_source_files(self, source_dir):
+        """Returns copies of a plain file, a Crypt4GH file and a private key."""
+        for name in ["hello.txt", "hello.c4gh", "alice.sec"]:
+            shutil.copy(INPUT_DIR/name, source_dir/name)
+        return [source_dir/name for name in ["hello.txt", "hello.c4gh", "alice.sec"]]
+
+    def test_defer_ciphertext_files(self, source_files, output_dir):
+        """Test that only the Crypt4GH files are left in place."""
+        moved_paths, entries = defer_ciphertext_files(source_files, output_dir)
+        assert moved_paths == [output_dir/"hello.txt", output_dir/"alice.sec"]
+        assert entries == [ManifestEntry(path=source_files[1], destination=output_dir/"hello.c4gh",
+                                         file_type=FileType.CRYPT4GH)]
+        assert source_files[1].exists()
+
+    def test_duplicate_names(self, source_files, output_dir):
+        """Test that an error is raised when two files have the same name."""
+        with pytest.raises(ValueError):
+            defer_ciphertext_files([source_files[1], source_files[1]], output_dir)
+
+    def test_stage_manifest(self, source_files, tmp_path, output_dir):
+        """Test that files with the ciphertext role are left in place."""
+        manifest_path = tmp_path/"manifest.ndjson"
+        manifest_path.write_text("".join(
+            f"{json.dumps({'path': str(path), 'role': role})}\n"
+            for path, role in zip(source_files, ["plain", "ciphertext", "key"])),
+            encoding="utf-8")
+        staged = stage_manifest(manifest_path, output_dir, defer_ciphertext=True)
+        assert [entry.path for entry in staged.deferred_entries] == [source_files[1]]
+        assert not staged.classified_paths[FileType.CRYPT4GH]
+        assert sorted(path.name for path in output_dir.iterdir()) == ["alice.sec", "hello.txt"]
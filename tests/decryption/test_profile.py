@@ -0,0 +1,99 @@
+"""Tests for profiling decrypt.py"""
+import json
+import pstats
+import shutil
+import threading
+import time
+
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    PROFILE_ENV,
+    SampledTimings,
+    SegmentBuffers,
+    StackSampler,
+    get_args,
+    main,
+    profile_call,
+)
+from tests.utils import INPUT_DIR, patch_cli
+
+
+def busy_wait(seconds):
+    """Keeps the CPU busy for a number of seconds."""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestSampledTimings:
+    """Test SampledTimings."""
+
+    def test_wrap(self):
+        """Test that every sample_every-th call is timed, starting with the first."""
+        timings = SampledTimings(sample_every=2)
+        double = timings.wrap("double", lambda x: 2 * x)
+        assert [double(x) for x in range(5)] == [0, 2, 4, 6, 8]
+        summary = timings.summary()["double"]
+        assert summary["calls"] == 5
+        assert summary["samples"] == 3
+        assert 0 <= summary["min_seconds"] <= summary["median_seconds"] <= summary["max_seconds"]
+
+    def test_patch(self):
+        """Test that methods are wrapped only within the context."""
+        decrypt = SegmentBuffers.decrypt
+        timings = SampledTimings()
+        with timings.patch(SegmentBuffers, ["decrypt"]):
+            assert SegmentBuffers.decrypt is not decrypt
+        assert SegmentBuffers.decrypt is decrypt
+        assert timings.summary()["SegmentBuffers.decrypt"]["samples"] == 0
+
+
+def test_stack_sampler(tmp_path):
+    """Test that the stacks of other threads are counted collapsed."""
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    worker = threading.Thread(target=busy_wait, args=(0.1,), name="worker")
+    worker.start()
+    worker.join()
+    sampler.stop()
+    sampler.write(tmp_path/"stacks.collapsed")
+    lines = (tmp_path/"stacks.collapsed").read_text(encoding="utf-8").splitlines()
+    worker_stacks = [line for line in lines if line.startswith("worker;")]
+    assert worker_stacks
+    stack, count = worker_stacks[0].rsplit(" ", 1)
+    assert stack.endswith(f"busy_wait (test_profile.py:{busy_wait.__code__.co_firstlineno})")
+    assert int(count) > 0
+
+
+def test_profile_call(tmp_path):
+    """Test that the profiles are written even if the function raises."""
+    with pytest.raises(ZeroDivisionError):
+        profile_call(lambda: 1 / 0, tmp_path/"profiles")
+    assert sorted(path.suffix for path in (tmp_path/"profiles").iterdir()) == [
+        ".collapsed", ".json", ".prof"]
+
+
+@pytest.mark.parametrize("pipeline", [[], ["--pipeline"]])
+def test_main(encrypted_files, tmp_path, output_dir, pipeline):
+    """Test that a profiled run decrypts the files and writes its profiles."""
+    shutil.copy(INPUT_DIR/"alice.sec", tmp_path/"alice.sec")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--jobs", "1", "--profile",
+                    str(tmp_path/"profiles"), *map(str, encrypted_files),
+                    str(tmp_path/"alice.sec")] + pipeline):
+        main()
+    assert (output_dir/"hello.c4gh").read_text(encoding="utf-8").startswith("hello")
+    prof, = (tmp_path/"profiles").glob("*.prof")
+    assert any(function == "_decrypt_inputs"
+               for _, _, function in pstats.Stats(str(prof)).stats)
+    segments, = (tmp_path/"profiles").glob("*.segments.json")
+    assert json.loads(segments.read_text(encoding="utf-8"))["SegmentBuffers.decrypt"]["calls"] == 2
+
+
+def test_profile_env(monkeypatch, tmp_path):
+    """Test that the profile directory defaults to the environment variable."""
+    monkeypatch.delenv(PROFILE_ENV, raising=False)
+    with patch_cli(["decrypt.py", "file.c4gh"]):
+        assert get_args().profile is None
+        monkeypatch.setenv(PROFILE_ENV, str(tmp_path))
+        assert get_args().profile == tmp_path
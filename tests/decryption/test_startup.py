@@ -0,0 +1,105 @@
+"""Tests for the startup of decrypt.py"""
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import time
+
+from crypt4gh import header
+from crypt4gh import lib
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    CIPHER_DIFF,
+    CIPHER_SEGMENT_SIZE,
+    MAGIC_NUMBER,
+    SEGMENT_SIZE,
+    LazyModule,
+)
+from tests.utils import INPUT_DIR
+
+DECRYPT_DIR = Path(__file__).parents[2]/"crypt4gh_middleware"
+# Seconds the imports of decrypt.py and a run on a plain file may take. Timings vary too much on
+# shared machines, so the budgets are only checked if set, e.g. to 0.15 and 0.4.
+IMPORT_BUDGET = os.environ.get("CRYPT4GH_IMPORT_BUDGET")
+STARTUP_BUDGET = os.environ.get("CRYPT4GH_STARTUP_BUDGET")
+# Modules that are only imported once a task needs them
+LAZY_MODULES = ("crypt4gh", "nacl", "asyncio", "http.client", "subprocess", "multiprocessing",
+                "concurrent.futures.process", "cProfile", "statistics")
+
+
+def run_decrypt(tmp_path, file_names, *python_args):
+    """Run decrypt.py as the decryption executor does on copies of input files.
+
+    Returns:
+        The seconds taken by the run and its stderr.
+    """
+    output_dir = tmp_path/"out"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    output_dir.mkdir()
+    for name in file_names:
+        shutil.copy(INPUT_DIR/name, tmp_path/name)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, *python_args, "-m", "decrypt", "--output-dir", str(output_dir),
+         *(str(tmp_path/name) for name in file_names)],
+        cwd=DECRYPT_DIR, capture_output=True, check=True, text=True)
+    return time.perf_counter() - start, process.stderr
+
+
+def get_import_times(importtime):
+    """Return the microseconds each module listed by -X importtime took to import, excluding the
+    modules it imported."""
+    times = {}
+    for line in importtime.splitlines():
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        if self_time.strip().isdigit():
+            times[name.strip()] = int(self_time)
+    return times
+
+
+def test_layout_constants():
+    """Test that the layout of Crypt4GH files matches the crypt4gh package."""
+    assert MAGIC_NUMBER == header.MAGIC_NUMBER
+    assert (SEGMENT_SIZE, CIPHER_DIFF, CIPHER_SEGMENT_SIZE) == (
+        lib.SEGMENT_SIZE, lib.CIPHER_DIFF, lib.CIPHER_SEGMENT_SIZE)
+
+
+def test_lazy_module():
+    """Test that a module is imported once an attribute is used."""
+    module = LazyModule("json.tool")
+    assert "main" not in vars(module)
+    assert module.main is sys.modules["json.tool"].main
+    assert "main" in vars(module)
+
+
+def test_plain_files_skip_lazy_modules(tmp_path):
+    """Test that a task without Crypt4GH files or keys does not import the lazy modules."""
+    _, importtime = run_decrypt(tmp_path, ["hello.txt"], "-X", "importtime")
+    import_times = get_import_times(importtime)
+    assert "argparse" in import_times
+    assert not [name for name in import_times if name.startswith(LAZY_MODULES)]
+
+
+def test_crypt4gh_files_import_crypto(tmp_path):
+    """Test that the Crypt4GH bindings are imported once a Crypt4GH file is decrypted."""
+    _, importtime = run_decrypt(tmp_path, ["hello.c4gh", "alice.sec"], "-X", "importtime")
+    assert {"crypt4gh.header", "nacl.bindings"} <= set(get_import_times(importtime))
+    assert (tmp_path/"out"/"hello.c4gh").read_text(encoding="utf-8").startswith("hello")
+
+
+@pytest.mark.skipif(IMPORT_BUDGET is None, reason="CRYPT4GH_IMPORT_BUDGET is not set")
+def test_import_budget(tmp_path):
+    """Test that the imports of a task without Crypt4GH files stay within the budget."""
+    import_seconds = min(sum(get_import_times(run_decrypt(tmp_path, ["hello.txt"], "-X",
+                                                           "importtime")[1]).values()) / 1e6
+                         for _ in range(3))
+    assert import_seconds < float(IMPORT_BUDGET)
+
+
+@pytest.mark.skipif(STARTUP_BUDGET is None, reason="CRYPT4GH_STARTUP_BUDGET is not set")
+@pytest.mark.parametrize("file_names", [["hello.txt"], ["hello.c4gh", "alice.sec"]])
+def test_startup_budget(tmp_path, file_names):
+    """Test that a run of decrypt.py on a single file stays within the budget."""
+    assert min(run_decrypt(tmp_path, file_names)[0] for _ in range(3)) < float(STARTUP_BUDGET)
@@ -0,0 +1,275 @@
+"""Tests for the decryption of streamed and remote files in decrypt.py"""
+import ast
+import json
+import os
+import sys
+from unittest import mock
+
+from crypt4gh.lib import SEGMENT_SIZE
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    COPY_BUFFER_SIZE,
+    DecryptionOptions,
+    FileType,
+    HTTPConnectionPool,
+    ManifestEntry,
+    ManifestError,
+    RemoteFile,
+    RemoteFileError,
+    decrypt_remote_files,
+    get_fifo_source_path,
+    get_segment_index_path,
+    install_launcher,
+    run_with_fifos,
+    stage_manifest,
+)
+from tests.utils import INPUT_TEXT
+
+
+class TestRunWithFifos:
+    """Test run_with_fifos."""
+
+    @staticmethod
+    def stage(tmp_path, output_dir, entries):
+        """Write entries to a manifest, stage it and return the manifest path."""
+        manifest_path = tmp_path/"manifest.ndjson"
+        manifest_path.write_text("".join(f"{json.dumps(entry)}\n" for entry in entries),
+                                 encoding="utf-8")
+        stage_manifest(manifest_path, output_dir)
+        return manifest_path
+
+    @pytest.fixture(name="manifest_path")
+    def fixture_manifest_path(self, files, tmp_path, output_dir):
+        """Returns a staged manifest with a streamed Crypt4GH file and a private key."""
+        return self.stage(tmp_path, output_dir, [
+            {"path": str(files[1]), "role": "ciphertext", "stream": True},
+            {"path": str(files[2]), "role": "key"},
+        ])
+
+    @staticmethod
+    def copy_command(source, destination, size=-1):
+        """Return a command copying up to size bytes of source to destination."""
+        return [sys.executable, "-c",
+                f"import sys; open(sys.argv[2], 'wb').write(open(sys.argv[1], 'rb').read({size}))",
+                str(source), str(destination)]
+
+    def test_stage_manifest(self, files, tmp_path, output_dir):
+        """Test that streamed files are staged next to their destination and not decrypted."""
+        manifest_path = tmp_path/"manifest.ndjson"
+        manifest_path.write_text(
+            json.dumps({"path": str(files[1]), "role": "ciphertext", "stream": True}) + "\n",
+            encoding="utf-8")
+        staged = stage_manifest(manifest_path, output_dir)
+        assert not staged.classified_paths[FileType.CRYPT4GH]
+        assert [entry.destination for entry in staged.streamed_entries] == [
+            output_dir/"hello.c4gh"]
+        assert os.listdir(output_dir) == [get_fifo_source_path(output_dir/"hello.c4gh").name]
+
+    def test_run_with_fifos(self, manifest_path, tmp_path, output_dir):
+        """Test that the command reads the plaintext and the named pipes are removed."""
+        fifo = output_dir/"hello.c4gh"
+        assert run_with_fifos(manifest_path, output_dir,
+                              self.copy_command(fifo, tmp_path/"copy.txt")) == 0
+        assert (tmp_path/"copy.txt").read_text(encoding="utf-8") == INPUT_TEXT
+        assert not fifo.exists()
+        assert get_fifo_source_path(fifo).exists()
+
+    def test_repeated_runs(self, manifest_path, tmp_path, output_dir):
+        """Test that every run gets fresh named pipes."""
+        for name in ["first.txt", "second.txt"]:
+            run_with_fifos(manifest_path, output_dir,
+                           self.copy_command(output_dir/"hello.c4gh", tmp_path/name))
+            assert (tmp_path/name).read_text(encoding="utf-8") == INPUT_TEXT
+
+    def test_launcher_syntax(self, output_dir):
+        """Test that the launcher, which runs under the Python of the executor's image, parses
+        with the grammar of Python 3.9."""
+        launcher_path = install_launcher(output_dir)
+        ast.parse(launcher_path.read_text(encoding="utf-8"), feature_version=(3, 9))
+
+    def test_exit_status(self, manifest_path, output_dir):
+        """Test that the exit status of a command that does not read the pipe is returned."""
+        assert run_with_fifos(manifest_path, output_dir,
+                              [sys.executable, "-c", "raise SystemExit(3)"]) == 3
+        assert not (output_dir/"hello.c4gh").exists()
+
+    def test_partial_read(self, files, make_encrypted_file, tmp_path, output_dir):
+        """Test that a command may close the pipe before reading all of it."""
+        file_path, plaintext = make_encrypted_file(4 * SEGMENT_SIZE)
+        manifest_path = self.stage(tmp_path, output_dir, [
+            {"path": str(file_path), "role": "ciphertext", "stream": True},
+            {"path": str(files[2]), "role": "key"},
+        ])
+        assert run_with_fifos(manifest_path, output_dir, self.copy_command(
+            output_dir/file_path.name, tmp_path/"head", size=10)) == 0
+        assert (tmp_path/"head").read_bytes() == plaintext[:10]
+
+    def test_undecryptable_file(self, files, tmp_path, output_dir):
+        """Test that files that cannot be decrypted are linked to their destination unchanged."""
+        ciphertext = files[1].read_bytes()
+        manifest_path = self.stage(tmp_path, output_dir, [
+            {"path": str(files[1]), "role": "ciphertext", "stream": True}])
+        assert run_with_fifos(manifest_path, output_dir,
+                              self.copy_command(output_dir/"hello.c4gh", tmp_path/"copy")) == 0
+        assert (tmp_path/"copy").read_bytes() == ciphertext
+        assert not (output_dir/"hello.c4gh").exists()
+
+
+class TestRemoteFile:
+    """Test RemoteFile and HTTPConnectionPool."""
+
+    @pytest.fixture(name="data")
+    def fixture_data(self, tmp_path):
+        """Returns the contents of a served file."""
+        data = os.urandom(100_000)
+        (tmp_path/"data.bin").write_bytes(data)
+        return data
+
+    def test_read(self, http_server, data):
+        """Test that the whole file is read and its size is known before reading."""
+        with HTTPConnectionPool() as pool, RemoteFile(f"{http_server.url}/data.bin", pool) as f:
+            assert f.size == len(data)
+            assert f.readall() == data
+
+    def test_range(self, http_server, data):
+        """Test that only the requested byte range is read."""
+        with (HTTPConnectionPool() as pool,
+              RemoteFile(f"{http_server.url}/data.bin", pool, 1000, 5000) as f):
+            assert f.readall() == data[1000:5000]
+            assert f.size == len(data)
+
+    def test_range_past_end(self, http_server, data):
+        """Test that a range extending past the end of the file is cut short."""
+        with (HTTPConnectionPool() as pool,
+              RemoteFile(f"{http_server.url}/data.bin", pool, 99_000, 200_000) as f):
+            assert f.readall() == data[99_000:]
+
+    def test_connections_reused(self, http_server, data):
+        """Test that connections are reused once a response has been read completely."""
+        with HTTPConnectionPool() as pool:
+            for start in range(0, len(data), 10_000):
+                with RemoteFile(f"{http_server.url}/data.bin", pool, start, start + 10_000) as f:
+                    assert f.readall() == data[start:start + 10_000]
+        assert http_server.requests == 10
+        assert http_server.connections == 1
+
+    def test_closed_early(self, http_server, data):
+        """Test that a connection is not reused if its response was closed before its end."""
+        with HTTPConnectionPool() as pool:
+            with RemoteFile(f"{http_server.url}/data.bin", pool) as f:
+                assert f.read(1000) == data[:1000]
+            with RemoteFile(f"{http_server.url}/data.bin", pool, 1000) as f:
+                assert f.readall() == data[1000:]
+        assert http_server.connections == 2
+
+    def test_resume(self, http_server, data):
+        """Test that dropped connections are resumed from the current position."""
+        http_server.truncate_responses = 2
+        with HTTPConnectionPool() as pool, RemoteFile(f"{http_server.url}/data.bin", pool) as f:
+            assert f.readall() == data
+        assert http_server.requests == 3
+
+    def test_too_many_failures(self, http_server, data):  # pylint: disable=unused-argument
+        """Test that an error is raised when the connection keeps dropping."""
+        http_server.truncate_responses = 100
+        with (HTTPConnectionPool() as pool, RemoteFile(f"{http_server.url}/data.bin", pool) as f,
+              pytest.raises(RemoteFileError)):
+            f.readall()
+
+    def test_not_found(self, http_server):
+        """Test that an error is raised for missing files."""
+        with HTTPConnectionPool() as pool, pytest.raises(RemoteFileError):
+            RemoteFile(f"{http_server.url}/missing.bin", pool)
+
+    def test_unsupported_scheme(self):
+        """Test that an error is raised for URLs that are not HTTP(S)."""
+        with HTTPConnectionPool() as pool, pytest.raises(RemoteFileError):
+            RemoteFile("ftp://example.org/data.bin", pool)
+
+
+class TestDecryptRemoteFiles:
+    """Test decrypt_remote_files."""
+
+    @staticmethod
+    def remote_entry(http_server, file_path, output_dir, size=None):
+        """Returns the manifest entry of a served file."""
+        return ManifestEntry(path=None, destination=output_dir/file_path.name,
+                             file_type=FileType.CRYPT4GH, size=size,
+                             url=f"{http_server.url}/{file_path.name}")
+
+    @pytest.mark.parametrize("jobs", [1, 4])
+    def test_decrypt(self, http_server, make_encrypted_file, alice_keys, output_dir, jobs):
+        """Test that remote files are decrypted, in segment ranges if they are large."""
+        files = [make_encrypted_file(size) for size in (0, 1000, 10 * SEGMENT_SIZE + 5)]
+        with mock.patch("crypt4gh_middleware.decrypt.SEGMENT_PARALLEL_THRESHOLD",
+                        4 * SEGMENT_SIZE):
+            decrypt_remote_files(
+                [self.remote_entry(http_server, file_path, output_dir) for file_path, _ in files],
+                [alice_keys[0]], jobs=jobs)
+        for file_path, plaintext in files:
+            assert (output_dir/file_path.name).read_bytes() == plaintext
+        assert not list(output_dir.glob(".*"))
+
+    def test_byte_ranges(self, http_server, make_encrypted_file, alice_keys, output_dir):
+        """Test that only the segments covering the byte ranges are fetched."""
+        file_path, plaintext = make_encrypted_file(10 * SEGMENT_SIZE)
+        byte_ranges = ((10, 20), (7 * SEGMENT_SIZE, 8 * SEGMENT_SIZE + 1))
+        decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)],
+                             [alice_keys[0]], options=DecryptionOptions(byte_ranges=byte_ranges,
+                                                                        segment_index=True))
+        assert (output_dir/file_path.name).read_bytes() == (
+            plaintext[10:20] + plaintext[7 * SEGMENT_SIZE:8 * SEGMENT_SIZE + 1])
+        # The header and one request per run of segments
+        assert http_server.requests == 3
+        assert get_segment_index_path(output_dir/file_path.name).exists()
+
+    def test_large_file(self, http_server, make_encrypted_file, alice_keys, output_dir):
+        """Test that the segment ranges of a file larger than the read buffer get fresh
+        connections after its header."""
+        file_path, plaintext = make_encrypted_file(4 * COPY_BUFFER_SIZE)
+        with mock.patch("crypt4gh_middleware.decrypt.SEGMENT_PARALLEL_THRESHOLD",
+                        4 * SEGMENT_SIZE):
+            decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)],
+                                 [alice_keys[0]], jobs=4)
+        assert (output_dir/file_path.name).read_bytes() == plaintext
+
+    def test_large_file_byte_ranges(self, http_server, make_encrypted_file, alice_keys,
+                                    output_dir):
+        """Test that the byte ranges of a file larger than the read buffer get fresh connections
+        after its header."""
+        file_path, plaintext = make_encrypted_file(4 * COPY_BUFFER_SIZE)
+        byte_ranges = ((10, 20), (2 * COPY_BUFFER_SIZE, 3 * COPY_BUFFER_SIZE))
+        decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)],
+                             [alice_keys[0]], options=DecryptionOptions(byte_ranges=byte_ranges))
+        assert (output_dir/file_path.name).read_bytes() == (
+            plaintext[10:20] + plaintext[2 * COPY_BUFFER_SIZE:3 * COPY_BUFFER_SIZE])
+
+    def test_ciphertext_never_staged(self, http_server, make_encrypted_file, alice_keys,
+                                     output_dir):
+        """Test that the ciphertext is not written to the output directory."""
+        file_path, _ = make_encrypted_file(1000)
+        with mock.patch("crypt4gh_middleware.decrypt.stage_file") as staged:
+            decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)],
+                                 [alice_keys[0]])
+            staged.assert_not_called()
+
+    def test_key_not_provided(self, http_server, make_encrypted_file, output_dir, caplog):
+        """Test that files without a matching key are saved unchanged."""
+        file_path, _ = make_encrypted_file(1000)
+        decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)], [])
+        assert (output_dir/file_path.name).read_bytes() == file_path.read_bytes()
+        assert "not provided" in caplog.text
+
+    def test_large_file_key_not_provided(self, http_server, make_encrypted_file, output_dir):
+        """Test that a file larger than the read buffer is saved unchanged without a key."""
+        file_path, _ = make_encrypted_file(4 * COPY_BUFFER_SIZE)
+        decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir)], [])
+        assert (output_dir/file_path.name).read_bytes() == file_path.read_bytes()
+
+    def test_size_mismatch(self, http_server, make_encrypted_file, alice_keys, output_dir):
+        """Test that an error is raised when the remote file does not have the expected size."""
+        file_path, _ = make_encrypted_file(1000)
+        with pytest.raises(ManifestError):
+            decrypt_remote_files([self.remote_entry(http_server, file_path, output_dir, 1)],
+                                 [alice_keys[0]])
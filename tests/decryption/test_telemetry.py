@@ -0,0 +1,149 @@
+"""Tests for the telemetry records of decrypt.py"""
+import io
+import json
+import shutil
+
+import pytest
+
+from crypt4gh_middleware.decrypt import (
+    DecryptionOptions,
+    KeyIndex,
+    ManifestError,
+    Measurement,
+    Telemetry,
+    decrypt_files,
+    main,
+    measure,
+    stage_file,
+    telemetry,
+)
+from tests.utils import INPUT_DIR, patch_cli
+
+
+def read_records(path):
+    """Returns the JSON records written to a telemetry file."""
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+@pytest.fixture(name="recording")
+def fixture_recording():
+    """Opens the module telemetry on a stream and returns the stream."""
+    stream = io.StringIO()
+    telemetry.open(stream)
+    yield stream
+    telemetry.close()
+
+
+class TestTelemetry:
+    """Test the Telemetry records."""
+
+    def test_disabled(self, capsys):
+        """Test that nothing is written until a stream is opened."""
+        records = Telemetry()
+        with records.phase("decrypt"):
+            records.file("decrypt", INPUT_DIR/"hello.c4gh", 1, 1, Measurement(1.0, 1.0))
+        assert records.summary("succeeded") is None
+        assert not capsys.readouterr().out
+
+    def test_records(self, capsys):
+        """Test that file records are totalled by phase and in the summary."""
+        stream = io.StringIO()
+        records = Telemetry()
+        records.open(stream)
+        with records.phase("stage"):
+            records.file("stage", INPUT_DIR/"hello.c4gh", 10, 10, Measurement(1.0, 0.5),
+                         strategy="rename")
+        with records.phase("decrypt"):
+            records.file("decrypt", INPUT_DIR/"hello.c4gh", 10, 8, Measurement(2.0, 1.5))
+            records.file("decrypt", INPUT_DIR/"hello2.c4gh", 20, 16, Measurement(0.0, 0.0))
+        summary = records.summary("succeeded")
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [(line["record"], line.get("phase")) for line in lines] == [
+            ("file", "stage"), ("phase", "stage"), ("file", "decrypt"), ("file", "decrypt"),
+            ("phase", "decrypt"), ("summary", None)]
+        assert lines[0]["strategy"] == "rename"
+        assert lines[2]["throughput_bytes_per_second"] == 4
+        assert lines[3]["throughput_bytes_per_second"] is None
+        assert lines[4]["operations"] == {"decrypt": {"files": 2, "bytes_in": 30, "bytes_out": 24}}
+        assert summary == lines[5]
+        assert summary["status"] == "succeeded"
+        assert summary["operations"]["stage"] == {"files": 1, "bytes_in": 10, "bytes_out": 10}
+        assert set(summary["phases"]) == {"stage", "decrypt"}
+        assert json.loads(capsys.readouterr().out) == summary
+
+    def test_measure(self):
+        """Test that measure returns the result of the function with its timing."""
+        result, measurement = measure(sum, [1, 2])
+        assert result == 3
+        assert measurement.wall_seconds >= 0
+        assert measurement.cpu_seconds >= 0
+
+
+def test_key_id(encrypted_files, alice_keys):
+    """Test that the header records the public key of the private key that opened it."""
+    crypt_header = KeyIndex([alice_keys[0]]).resolve_header(encrypted_files[0])
+    assert crypt_header.key_id == alice_keys[1].hex()
+
+
+def test_stage_file_record(recording, tmp_path):
+    """Test that staged files are recorded with their strategy."""
+    (tmp_path/"src.txt").write_bytes(b"12345")
+    stage_file(tmp_path/"src.txt", tmp_path/"dest.txt")
+    record, = [json.loads(line) for line in recording.getvalue().splitlines()]
+    assert record["operation"] == "stage"
+    assert record["path"] == str(tmp_path/"dest.txt")
+    assert record["bytes_in"] == record["bytes_out"] == 5
+    assert record["strategy"] == "rename"
+
+
+@pytest.mark.parametrize("jobs, in_place", [(1, False), (2, False), (1, True)])
+def test_decrypt_files_records(recording, encrypted_files, alice_keys, jobs, in_place):
+    """Test that each decrypted file is recorded with its sizes and key, but not skipped files."""
+    decrypt_files(encrypted_files, [alice_keys[0]], jobs=jobs,
+                  options=DecryptionOptions(in_place=in_place))
+    records = [json.loads(line) for line in recording.getvalue().splitlines()]
+    assert sorted(record["path"] for record in records) == sorted(map(str, encrypted_files[:2]))
+    for record in records:
+        assert record["operation"] == "decrypt"
+        assert record["bytes_out"] < record["bytes_in"]
+        assert record["key"] == alice_keys[1].hex()
+        assert record["cpu_seconds"] >= 0
+
+
+@pytest.mark.parametrize("pipeline", [[], ["--pipeline"]])
+def test_main(encrypted_files, tmp_path, output_dir, pipeline, capsys):
+    """Test that main writes file, phase and summary records and prints the summary."""
+    shutil.copy(INPUT_DIR/"alice.sec", tmp_path/"alice.sec")
+    with patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--telemetry",
+                    str(tmp_path/"telemetry.jsonl"), *map(str, encrypted_files),
+                    str(tmp_path/"alice.sec")] + pipeline):
+        main()
+    records = read_records(tmp_path/"telemetry.jsonl")
+    summary = records[-1]
+    assert summary["record"] == "summary"
+    assert summary["status"] == "succeeded"
+    assert summary["operations"]["stage"]["files"] == 4
+    assert summary["operations"]["decrypt"]["files"] == 2
+    assert {record["phase"] for record in records if record["record"] == "phase"} == {
+        "stage", "identify", "keys", "decrypt", "pipeline", "remote"}
+    assert json.loads(capsys.readouterr().out) == summary
+    assert not telemetry.enabled
+
+
+def test_main_failure(tmp_path, output_dir, capsys):
+    """Test that the summary of a failed run is written and the cleanup is recorded."""
+    for name in ["hello.c4gh", "alice.sec"]:
+        shutil.copy(INPUT_DIR/name, tmp_path/name)
+    manifest_path = tmp_path/"manifest.ndjson"
+    manifest_path.write_text(
+        json.dumps({"path": str(tmp_path/"hello.c4gh"), "plaintext_checksum": "sha256:00"})
+        + "\n" + json.dumps({"path": str(tmp_path/"alice.sec")}) + "\n", encoding="utf-8")
+    with (patch_cli(["decrypt.py", "--output-dir", str(output_dir), "--telemetry", "-",
+                     "--manifest", str(manifest_path)]),
+          pytest.raises(ManifestError)):
+        main()
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records[-2]["phase"] == "cleanup"
+    assert records[-1]["record"] == "summary"
+    assert records[-1]["status"] == "failed"
+    assert not telemetry.enabled
@@ -1,8 +1,11 @@
 """ Utility functions for tests."""
-from functools import wraps
+from functools import partial, wraps
 import contextlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+import re
 import signal
+import threading
 from unittest import mock
 
 INPUT_DIR = Path(__file__).parents[1]/"inputs"
@@ -31,3 +34,73 @@ def timeout(time_limit):
             return result
         return wrapper
     return decorator
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with support for single byte-range requests, standing in for S3 or MinIO.
+
+    Connections are kept alive. The server counts connections and requests and truncates the
+    first truncate_responses responses after half of their body to simulate dropped connections.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the whole file or the requested byte range."""
+        self.server.requests += 1
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return
+        data = path.read_bytes()
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]) + 1 if match[2] else len(data), len(data))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+            body = data[start:end]
+        else:
+            self.send_response(200)
+            body = data
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.truncate_responses:
+            self.server.truncate_responses -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep test output quiet."""
+
+
+@contextlib.contextmanager
+def serve_directory(directory):
+    """Context manager that serves a directory over HTTP and yields the server.
+
+    The base URL of the directory is available as server.url.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeRequestHandler,
+                                                           directory=str(directory)))
+    server.connections = server.requests = server.truncate_responses = 0
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01},
+                              daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()